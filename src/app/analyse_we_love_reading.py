@@ -4,20 +4,33 @@ import sys
 sys.path.append(str(Path(__file__).resolve().parent.parent)) # the dir containing utils
 import utils.parameters as params
 import utils.common as common
-import utils.nk_pipeline as nk_pipeline
 import utils.data_utils as data_utils
 import numpy as np
 import pandas as pd
 from datetime import datetime
 import traceback
-from typing import Dict, Union, Optional, List, Tuple
+import argparse
+import os
+import logging
+import logging.handlers
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Mapping, Union, Optional, List, Tuple
 #fmt:on
 
+LOGGER_NAME = 'ECG_HRV_LOGGER'
+# Environment variables that limit the number of threads of the numerical libraries (BLAS, OpenMP, Numba) 
+# in the worker processes, since the parallelism comes from the worker processes themselves
+WORKER_THREAD_LIMIT_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMBA_NUM_THREADS')
+
 def process_all_dyads(
     raw_data_dir: Union[str, Path] = Path(__file__).resolve().parent.parent.parent / 'data' / 'raw',
     processed_data_dir: Union[str, Path] = Path(__file__).resolve().parent.parent.parent / 'data' / 'processed',
     reports_dir: Union[str, Path] = Path(__file__).resolve().parent.parent.parent / 'reports',
-    create_qa_plots: bool=True
+    create_qa_plots: bool=True,
+    max_workers: Optional[int]=None,
+    legacy_xlsx: bool=False,
+    force: bool=False
     ) -> None:
     """
     Processes all ECG and event data files for multiple dyads (mother-child pairs) in a specified raw data directory. 
@@ -33,20 +46,34 @@ def process_all_dyads(
             Defaults to the 'reports' folder located at the root level.
         create_qa_plots (bool, optional): Whether or not to generate and save Quality Assurance plots. 
             Defaults to True.
+        max_workers (Optional[int], optional): Number of worker processes used to process the dyads in parallel.
+            Defaults to None, in which case the number of CPUs available to this process is used.
+        legacy_xlsx (bool, optional): Whether to save the HRV metrics as Excel files and the processed signals as csv files
+            instead of Parquet files. Defaults to False.
+        force (bool, optional): Whether to process all dyads, including the dyads whose outputs already exist and are newer 
+            than their ECG file. Use this after changing the parameters. Defaults to False.
 
     Returns:
         None
 
     Raises:
-        AssertionError: If the raw data directory does not exist or if the number of ECG and event files do not match.
+        AssertionError: If the raw data directory does not exist. ECG files without a matching event file 
+            (e.g., B01_W1_mc.txt and B01_W1_event.txt) are skipped with a warning.
 
     Workflow:
         - Initializes the required directories (logs, processed data, and QA reports).
         - Sets up logging for tracking the progress of the processing and any errors.
-        - Iterates through the raw ECG and event files, ensuring that there are matching pairs.
+        - Iterates through the raw ECG files and pairs each of them with its event file by name.
+        - Distributes the pairs over a pool of worker processes. Since dyads are independent, they are processed in parallel.
+          The workers are started with 'forkserver' where available (Linux), such that they do not inherit the memory of this process.
+          With more than one worker, the numerical libraries are limited to a single thread per worker to avoid oversubscription.
+          If there are fewer dyads than workers, the segments of each dyad are processed in parallel as well, and if there 
+          are at least two workers per dyad, the child and the mother of each dyad are processed in separate processes.
+        - Skips the dyads whose outputs already exist (unless `force` is enabled), such that an interrupted run can be resumed.
         - For each pair, preprocesses and segments the ECG data, performs HRV analysis, and saves the results.
         - Logs information about the processing steps and any errors encountered.
         - Optionally generates and saves QA plots for each dyad.
+        - Concatenates the HRV metrics of all dyads and saves them in a single file ('all_hrv.parquet') in the processed data directory.
     
     Notes:
         - Uses the base parameters defined in the 'parameters.py' file for processing the ECG data.
@@ -64,14 +91,15 @@ def process_all_dyads(
     PROCESSED_DATA_DIR = Path(processed_data_dir)
     PROCESSED_DATA_DIR.mkdir(parents=False, exist_ok=True)
     QA_REPORTS_DIR = Path(reports_dir) / 'QA'
-    QA_REPORTS_DIR.mkdir(parents=True, exist_ok=True) 
+    if create_qa_plots:
+        QA_REPORTS_DIR.mkdir(parents=True, exist_ok=True) 
     
     # Set up logger
     TIMESTAMP = datetime.strftime(datetime.now(), "%Y%m%d%H%M%S")
 
     LOGGING_FILEPATH = LOGGING_DIR / \
         f"{TIMESTAMP}_logs.log"
-    logger = common.Logger(name='ECG_HRV_LOGGER',
+    logger = common.Logger(name=LOGGER_NAME,
                                       log_file=LOGGING_FILEPATH).get_logger()
     
     # Log some parameters
@@ -80,39 +108,100 @@ def process_all_dyads(
     logger.info(f"QA_REPORTS_DIR: {QA_REPORTS_DIR}")
     logger.info(f"LOGGING_DIR: {LOGGING_DIR}")
     logger.info(f"create_qa_plots: {create_qa_plots}")
+    logger.info(f"legacy_xlsx: {legacy_xlsx}")
+    logger.info(f"force: {force}")
     
     # Some checks
     assert RAW_DATA_DIR.is_dir(), f"Data directory in {DATA_DIR} does not exist."
 
-    # Get ECG filenames
-    ecg_filepaths = np.sort(list(RAW_DATA_DIR.glob('*mc.txt')))
-    logger.info(ecg_filepaths)
+    # Get ECG filenames and the corresponding Event filenames
+    ecg_filepaths, event_filepaths = data_utils.find_ecg_event_filepaths(RAW_DATA_DIR)
+    logger.info("Found %d ECG / %d event files", len(ecg_filepaths), len(event_filepaths))
+    logger.debug("ECG files: %s", ecg_filepaths)
+    logger.debug("Event files: %s", event_filepaths)
 
-    # Get Event filenames
-    event_filepaths = np.sort(list(RAW_DATA_DIR.glob('*event.txt')))
-    logger.info(event_filepaths)
+    ### Calculate
+    # The dyads are processed in separate processes. Their log records are sent to a queue and written 
+    # by a listener in this process, such that all logs end up in the same log file.
+    # sched_getaffinity respects CPU pinning (e.g., cgroups of batch jobs), but is not available on all platforms
+    max_workers = max_workers or (len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count())
+    logger.info(f"max_workers: {max_workers}")
+    if max_workers > 1:
+        # The variables are read when the libraries are loaded, so they are set before the workers are started 
+        # (which inherit the environment). Values that have been set explicitly by the user are kept.
+        for env_var in WORKER_THREAD_LIMIT_ENV_VARS:
+            os.environ.setdefault(env_var, '1')
+    mp_context = get_mp_context()
+    log_queue = mp_context.Queue()
+    log_listener = logging.handlers.QueueListener(log_queue, *logger.handlers, respect_handler_level=True)
+    log_listener.start()
+    
+    # If there are fewer dyads than workers, the spare CPUs are used to process the segments of a dyad in parallel
+    parallel_segments = len(ecg_filepaths) < max_workers
+    parallel_subjects = 2 * len(ecg_filepaths) <= max_workers
+    logger.info(f"parallel_segments: {parallel_segments}")
+    logger.info(f"parallel_subjects: {parallel_subjects}")
+    tasks = [
+        (ecg_filepath, event_filepath, params.base_params, PROCESSED_DATA_DIR, QA_REPORTS_DIR, create_qa_plots, legacy_xlsx, parallel_segments, parallel_subjects, force, index, len(ecg_filepaths))
+        for index, (ecg_filepath, event_filepath) in enumerate(zip(ecg_filepaths, event_filepaths), 1)
+    ]
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context, initializer=common.configure_queue_logger, initargs=(LOGGER_NAME, log_queue)) as executor:
+            all_hrv_dfs = [hrv_df for hrv_df in executor.map(process_dyad_task, tasks) if hrv_df is not None]
+    finally:
+        log_listener.stop()
+    
+    # Save the HRV metrics of all dyads in a single file
+    if all_hrv_dfs:
+        pd.concat(all_hrv_dfs, ignore_index=True).to_parquet(PROCESSED_DATA_DIR / 'all_hrv.parquet', index=False, compression='zstd')
+        logger.info(f"Saved HRV metrics of {len(all_hrv_dfs)}/{len(tasks)} recordings in {PROCESSED_DATA_DIR / 'all_hrv.parquet'}")
 
-    # check whether we have the same number of ECG and Event files
-    assert len(ecg_filepaths) == len(event_filepaths)
+def process_dyad_task(task: Tuple) -> Optional[pd.DataFrame]:
+    """
+    Processes a single dyad inside a worker process of `process_all_dyads`. Errors are logged and not raised,
+    such that a single failing dyad does not stop the processing of the other dyads.
 
-    ### Calculate
-    for index in range(len(ecg_filepaths)):
-        try:
-            dyad_number, condition, wave = data_utils.extract_subject_id_condition_from_filepath(ecg_filepaths[index])
-            logger.info(f"Processing recording {index+1}/{len(ecg_filepaths)}. Dyad number: {dyad_number}. Condition: {condition}. Wave: {wave}")
-            
-            process_dyad(
-                ecg_filepath = ecg_filepaths[index],
-                event_filepath = event_filepaths[index],
-                parameters=params.base_params,
-                data_output_dir=PROCESSED_DATA_DIR,
-                figure_output_dir=QA_REPORTS_DIR,
-                create_qa_plots=create_qa_plots
-            );
-        except Exception as e:
-            logger.error(f"Error processing {ecg_filepaths[index]}:{e}")
-            logger.debug("Traceback:\n" + traceback.format_exc())
-            traceback.print_exc()
+    Args:
+        task (Tuple): A tuple of (ecg_filepath, event_filepath, parameters, data_output_dir, figure_output_dir, 
+            create_qa_plots, legacy_xlsx, parallel_segments, parallel_subjects, force, recording_number, n_recordings). The first nine elements 
+            are passed to `process_dyad`. If `force` is False and the outputs of the dyad are up to date, the dyad is not processed again. 
+            The last two elements are only used for logging the progress.
+
+    Returns:
+        Optional[pd.DataFrame]: The HRV metrics of the child and the mother as returned by `process_dyad` (or as loaded 
+            from the existing output files), or None if the processing failed.
+    """
+    ecg_filepath, event_filepath, parameters, data_output_dir, figure_output_dir, create_qa_plots, legacy_xlsx, parallel_segments, parallel_subjects, force, recording_number, n_recordings = task
+    logger = logging.getLogger(LOGGER_NAME)
+    try:
+        dyad_number, condition, wave = data_utils.extract_subject_id_condition_from_filepath(ecg_filepath)
+        hrv_filepaths = get_hrv_output_filepaths(data_output_dir, dyad_number, condition, wave, legacy_xlsx)
+        if not force and outputs_up_to_date(ecg_filepath, [*hrv_filepaths, hrv_filepaths[0].parent / 'mother_params.yml']):
+            logger.info(f"Skipping recording {recording_number}/{n_recordings} since its outputs already exist. Dyad number: {dyad_number}. Condition: {condition}. Wave: {wave}")
+            read_hrv_file = pd.read_excel if legacy_xlsx else pd.read_parquet
+            return pd.concat([read_hrv_file(filepath) for filepath in hrv_filepaths], ignore_index=True)
+        
+        logger.info(f"Processing recording {recording_number}/{n_recordings}. Dyad number: {dyad_number}. Condition: {condition}. Wave: {wave}")
+        
+        hrv_df = process_dyad(
+            ecg_filepath = ecg_filepath,
+            event_filepath = event_filepath,
+            parameters=parameters,
+            data_output_dir=data_output_dir,
+            figure_output_dir=figure_output_dir,
+            create_qa_plots=create_qa_plots,
+            legacy_xlsx=legacy_xlsx,
+            parallel_segments=parallel_segments,
+            parallel_subjects=parallel_subjects,
+            subject_info=(dyad_number, condition, wave)
+        )
+        logger.info(f"Finished recording {recording_number}/{n_recordings}. Dyad number: {dyad_number}. Condition: {condition}. Wave: {wave}")
+        return hrv_df
+    except Exception as e:
+        logger.error(f"Error processing {ecg_filepath}:{e}")
+        logger.debug("Traceback:\n" + traceback.format_exc())
+        traceback.print_exc()
+        return None
 
 def process_dyad(ecg_filepath: Union[str, Path],
                  event_filepath: Union[str, Path], 
@@ -120,7 +209,11 @@ def process_dyad(ecg_filepath: Union[str, Path],
                  data_output_dir: Union[str, Path], 
                  figure_output_dir: Optional[Union[str, Path]],
                  create_qa_plots: bool=True,
-                    ) -> None:
+                 legacy_xlsx: bool=False,
+                 parallel_segments: bool=False,
+                 parallel_subjects: bool=False,
+                 subject_info: Optional[Tuple[int, str, str]]=None,
+                    ) -> pd.DataFrame:
     """
     Main function for processing ECG data of a dyad (mother and child). 
     This function performs preprocessing and HRV analysis for both child and mother ECG signals 
@@ -135,9 +228,18 @@ def process_dyad(ecg_filepath: Union[str, Path],
         figure_output_dir (Optional[Union[str, Path]]): Directory where Quality Assurance (QA) plots will be saved 
             if `create_qa_plots` is set to True.
         create_qa_plots (bool): Whether to create and save Quality Assurance plots during the processing.
+        legacy_xlsx (bool): Whether to save the HRV metrics as Excel files and the processed signals as csv files
+            instead of Parquet files. Defaults to False.
+        parallel_segments (bool): Whether to process the segments of a subject in parallel threads 
+            (see `compute_windowed_hrv_across_segments`). Defaults to False.
+        parallel_subjects (bool): Whether to process the child and the mother in two separate worker processes instead of 
+            one after the other. This roughly halves the processing time of a dyad if two CPUs are available, but holds the 
+            intermediate data of both subjects in memory at the same time. Defaults to False.
+        subject_info (Optional[Tuple[int, str, str]]): The subject ID, condition, and wave of the ECG file if they 
+            have already been extracted from the file path. Defaults to None, in which case they are extracted here.
 
     Returns:
-        None
+        pd.DataFrame: The HRV metrics of both the child and the mother.
 
     Raises:
         KeyError: If required keys are missing from the parameter dictionaries.
@@ -146,10 +248,13 @@ def process_dyad(ecg_filepath: Union[str, Path],
     Workflow:
         - Extracts subject ID, condition, and wave from the provided file paths.
         - Loads and prepares ECG and event data.
+        - Processes the child and then the mother with `process_subject`, such that only the intermediate data 
+          of one subject is held in memory at a time (or both at once if `parallel_subjects` is enabled). Per subject, it:
         - Applies preprocessing to the raw ECG data
         - Segments the preprocessed ECG signals for both mother and child.
         - Computes various HRV metrics for all analysis windows within a segment.
-        - Saves the HRV metrics and processed signal data as Excel and CSV files.
+        - Saves the HRV metrics (and, if `export_segment_signals` is enabled in the parameters, the processed signal data) as 
+          Parquet files (or as Excel and CSV files if `legacy_xlsx` is enabled).
         - Optionally saves QA plots if `create_qa_plots` is enabled.
         - Exports parameter settings to YAML files.
 
@@ -158,7 +263,7 @@ def process_dyad(ecg_filepath: Union[str, Path],
     """
     
     # Some basic checks
-    subject_id_ecg, condition_ecg, wave_ecg = data_utils.extract_subject_id_condition_from_filepath(ecg_filepath)
+    subject_id_ecg, condition_ecg, wave_ecg = subject_info or data_utils.extract_subject_id_condition_from_filepath(ecg_filepath)
     subject_id_event, condition_event, wave_event = data_utils.extract_subject_id_condition_from_filepath(event_filepath)
     assert subject_id_ecg == subject_id_event, f"Subject IDs do not match. Got {subject_id_ecg} = {subject_id_event}"
     assert condition_ecg == condition_event, f"Conditions do not match. Got {condition_ecg} = {condition_event}"
@@ -167,74 +272,154 @@ def process_dyad(ecg_filepath: Union[str, Path],
     # Load and prepare data
     signal_event_df = data_utils.load_dyad_ecg_events(ecg_filepath, event_filepath)
     child_series, mother_series = data_utils.split_in_child_mother_series(signal_event_df)
+    events_df = signal_event_df[["event", "event_description"]]
+    del signal_event_df
 
     # prepare parameters
-    segmentation_params = params.configure_segmentation_params(subject_id_ecg, parameters)
-    child_params, mother_params = params.configure_ecg_params(subject_id_ecg, segmentation_params.copy())
+    segmentation_params, child_params, mother_params = params.resolve_subject_params(subject_id_ecg, parameters)
     
     # Create output directories -> subjects are actually dyads but both go in same folder
-    data_output_dir = data_output_dir / f"{condition_ecg}_{subject_id_ecg}_{wave_ecg}"
-    data_output_dir.mkdir(parents=True, exist_ok=True)
-    qa_reports_dir = figure_output_dir / f"{condition_ecg}_{subject_id_ecg}_{wave_ecg}"
-    qa_reports_dir.mkdir(parents=True, exist_ok=True)
+    hrv_child_filepath, hrv_mother_filepath = get_hrv_output_filepaths(data_output_dir, subject_id_ecg, condition_ecg, wave_ecg, legacy_xlsx)
+    data_output_dir = common.ensure_dir(get_dyad_output_dir(data_output_dir, subject_id_ecg, condition_ecg, wave_ecg))
+    qa_reports_dir = None
+    if create_qa_plots:
+        qa_reports_dir = common.ensure_dir(get_dyad_output_dir(figure_output_dir, subject_id_ecg, condition_ecg, wave_ecg))
+
+    # NeuroKit2, scipy and matplotlib are slow to import, so they are only imported once a dyad is actually 
+    # processed (e.g., not in worker processes that only skip up-to-date dyads)
+    import matplotlib
+    matplotlib.use('Agg') # non-interactive backend: the QA plots are only saved to file, and it is safe to use in worker processes
+    import utils.nk_pipeline as nk_pipeline
+
+    subject_kwargs = dict(
+        events_df=events_df,
+        segmentation_params=segmentation_params,
+        data_output_dir=data_output_dir,
+        figure_output_dir=qa_reports_dir,
+        subject_info=(subject_id_ecg, condition_ecg, wave_ecg),
+        create_qa_plots=create_qa_plots,
+        legacy_xlsx=legacy_xlsx,
+        parallel_segments=parallel_segments
+    )
+    if parallel_subjects:
+        # The subjects are independent, so they are processed in two worker processes. The frozen parameters 
+        # cannot be pickled, so mutable copies are sent to the workers.
+        subject_kwargs['segmentation_params'] = params.clone_params(segmentation_params)
+        with ProcessPoolExecutor(max_workers=2, mp_context=get_mp_context()) as executor:
+            child_future = executor.submit(process_subject, child_series, "child", params.clone_params(child_params), hrv_filepath=hrv_child_filepath, **subject_kwargs)
+            mother_future = executor.submit(process_subject, mother_series, "mother", params.clone_params(mother_params), hrv_filepath=hrv_mother_filepath, **subject_kwargs)
+            del child_series, mother_series
+            hrv_child_df, hrv_mother_df = child_future.result(), mother_future.result()
+    else:
+        # The child is processed end-to-end (up to and including saving its outputs) before the mother, such that 
+        # the intermediate data of only one subject is held in memory at a time
+        hrv_child_df = process_subject(child_series, "child", child_params, hrv_filepath=hrv_child_filepath, **subject_kwargs)
+        del child_series
+        hrv_mother_df = process_subject(mother_series, "mother", mother_params, hrv_filepath=hrv_mother_filepath, **subject_kwargs)
+    
+    return pd.concat([hrv_child_df, hrv_mother_df], ignore_index=True)
+
+def process_subject(ecg_series: pd.Series,
+                    subject_type: str,
+                    subject_params: Mapping,
+                    events_df: pd.DataFrame,
+                    segmentation_params: Mapping,
+                    hrv_filepath: Path,
+                    data_output_dir: Path,
+                    figure_output_dir: Optional[Path],
+                    subject_info: Tuple[int, str, str],
+                    create_qa_plots: bool=True,
+                    legacy_xlsx: bool=False,
+                    parallel_segments: bool=False,
+                    ) -> pd.DataFrame:
+    """
+    Processes the ECG data of a single subject (the child or the mother) of a dyad: preprocesses and segments 
+    the ECG signal, computes the windowed HRV metrics, and saves the HRV metrics, the processed signal (if the 'export_segment_signals' 
+    parameter is enabled), and the parameters.
+
+    Args:
+        ecg_series (pd.Series): The raw ECG signal of the subject, indexed by time (in seconds).
+        subject_type (str): Either "child" or "mother". Used for the output file names and the `subject_type` column.
+        subject_params (Mapping): The (ECG) parameters of the subject, see `params.resolve_subject_params`.
+        events_df (pd.DataFrame): The 'event' and 'event_description' columns of the loaded data, 
+            with the same index as `ecg_series`.
+        segmentation_params (Mapping): The segmentation parameters of the dyad.
+        hrv_filepath (Path): The file path where the HRV metrics are saved (see `get_hrv_output_filepaths`).
+        data_output_dir (Path): The (existing) output directory of the dyad for the processed signal and the parameters.
+        figure_output_dir (Optional[Path]): The (existing) QA report directory of the dyad, or None if `create_qa_plots` is False.
+        subject_info (Tuple[int, str, str]): The subject ID, condition, and wave of the dyad.
+        create_qa_plots (bool): Whether to create and save Quality Assurance plots. Defaults to True.
+        legacy_xlsx (bool): Whether to save Excel and csv files instead of Parquet files. Defaults to False.
+        parallel_segments (bool): Whether to process the segments in parallel threads. Defaults to False.
+
+    Returns:
+        pd.DataFrame: The HRV metrics of the subject.
+    """
+    import utils.nk_pipeline as nk_pipeline # imported lazily, see process_dyad
+    subject_id, condition, wave = subject_info
 
     # Preprocess ECG data
-    child_signals_df = nk_pipeline.ecg_preprocess(child_series, child_params)
-    mother_signals_df = nk_pipeline.ecg_preprocess(mother_series, mother_params)
+    signals_df = nk_pipeline.ecg_preprocess(ecg_series, subject_params)
     
     # Join the preprocessed signals with the events
-    child_signal_event_df = child_signals_df.merge(signal_event_df[["event", "event_description"]], left_index=True, right_index=True, how = "left")
-    mother_signal_event_df = mother_signals_df.merge(signal_event_df[["event", "event_description"]], left_index=True, right_index=True, how = "left")
+    signal_event_df = data_utils.add_event_columns(signals_df, events_df)
+    del signals_df
     
-    # segment the dataframes
-    child_segments_df_list = data_utils.segment_df(child_signal_event_df, segmentation_params)
-    mother_segments_df_list = data_utils.segment_df(mother_signal_event_df, segmentation_params)
+    # segment the dataframe
+    segments_df_list = data_utils.segment_df(signal_event_df, segmentation_params)
+    del signal_event_df
     
-    # Compute windowed HRV metrics per segment and subject
-    hrv_child_df, ecg_child_df = compute_windowed_hrv_across_segments(
-        segments_df_list=child_segments_df_list,
-        parameters=child_params,
-        figure_output_dir=qa_reports_dir,
-        data_output_dir=data_output_dir,
-        subject_pair="child",
-        create_qa_plots=create_qa_plots
-    )
+    # The processed signals are only exported on request, since they are large and often not needed
+    export_segment_signals = subject_params['general'].get('export_segment_signals', False)
     
-    hrv_mother_df, ecg_mother_df = compute_windowed_hrv_across_segments(
-        segments_df_list=mother_segments_df_list,
-        parameters=mother_params,
-        figure_output_dir=qa_reports_dir,
+    # Compute windowed HRV metrics per segment
+    hrv_df, ecg_df = compute_windowed_hrv_across_segments(
+        segments_df_list=segments_df_list,
+        parameters=subject_params,
+        figure_output_dir=figure_output_dir,
         data_output_dir=data_output_dir,
-        subject_pair="mother",
-        create_qa_plots=create_qa_plots
+        subject_pair=subject_type,
+        create_qa_plots=create_qa_plots,
+        parallel_segments=parallel_segments,
+        concatenate_signals=export_segment_signals
     )
+    del segments_df_list
     
-    # Add extra info and save the HRV metrics
-    hrv_child_df = hrv_child_df.assign(subject_type = "child", condition = condition_ecg, wave = wave_ecg, subject_id=subject_id_ecg)
-    hrv_child_df.to_excel(data_output_dir / f'{condition_ecg}{subject_id_ecg}_{wave_ecg}_child_hrv.xlsx', index=False)
+    # Add extra info to the HRV metrics
+    hrv_df = hrv_df.assign(subject_type = subject_type, condition = condition, wave = wave, subject_id=subject_id)
     
-    hrv_mother_df = hrv_mother_df.assign(subject_type = "mother", condition = condition_ecg, wave = wave_ecg,subject_id=subject_id_ecg)
-    hrv_mother_df.to_excel(data_output_dir / f'{condition_ecg}{subject_id_ecg}_{wave_ecg}_mother_hrv.xlsx', index=False)
-
-    # Add extra info and save the processed signal data
-    ecg_child_df = ecg_child_df.assign(subject_type = "child", condition = condition_ecg, wave = wave_ecg,subject_id=subject_id_ecg)
-    ecg_child_df.to_csv(data_output_dir / f'{condition_ecg}{subject_id_ecg}_{wave_ecg}_child_signal.csv', index=False)
+    # Save the HRV metrics (and the processed signal data)
+    output_prefix = f'{condition}{subject_id}_{wave}'
+    if legacy_xlsx:
+        # xlsxwriter is considerably faster than the default openpyxl engine. Its constant_memory mode cannot be 
+        # used since pandas writes the cells column by column, whereas constant_memory only accepts row-wise writes
+        hrv_df.to_excel(hrv_filepath, index=False, engine='xlsxwriter')
+    else:
+        # Parquet is a compressed columnar format that is much faster to write (and read) than Excel and csv
+        hrv_df.to_parquet(hrv_filepath, index=False, compression='zstd')
     
-    ecg_mother_df = ecg_mother_df.assign(subject_type = "mother", condition = condition_ecg, wave = wave_ecg,subject_id=subject_id_ecg)
-    ecg_mother_df.to_csv(data_output_dir / f'{condition_ecg}{subject_id_ecg}_{wave_ecg}_mother_signal.csv', index=False)
+    if export_segment_signals:
+        ecg_df = add_constant_columns(ecg_df, subject_type = subject_type, condition = condition, wave = wave, subject_id=subject_id)
+        if legacy_xlsx:
+            ecg_df.to_csv(data_output_dir / f'{output_prefix}_{subject_type}_signal.csv', index=False)
+        else:
+            ecg_df.to_parquet(data_output_dir / f'{output_prefix}_{subject_type}_signal.parquet', index=False, compression='zstd')
     
     # Save the parameters
-    common.export_to_yaml(child_params, data_output_dir/'child_params.yml')
-    common.export_to_yaml(mother_params, data_output_dir/'mother_params.yml')
+    common.export_to_yaml(params.clone_params(subject_params), data_output_dir / f'{subject_type}_params.yml')
+    
+    return hrv_df
     
 def compute_windowed_hrv_across_segments(
     segments_df_list: List[pd.DataFrame], 
     parameters: Dict, 
-    figure_output_dir: Union[str, Path], 
+    figure_output_dir: Optional[Union[str, Path]], 
     data_output_dir: Union[str, Path], 
     subject_pair: str,
-    create_qa_plots:bool=True
-) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    create_qa_plots:bool=True,
+    parallel_segments:bool=False,
+    concatenate_signals:bool=True
+) -> Tuple[pd.DataFrame, Optional[pd.DataFrame]]:
     """
     Compute windowed heart rate variability (HRV) metrics for each segment and return concatenated results.
 
@@ -251,9 +436,10 @@ def compute_windowed_hrv_across_segments(
         parameters (Dict): 
             A dictionary containing parameters for HRV calculation.
             
-        figure_output_dir (Union[str, Path]): 
+        figure_output_dir (Optional[Union[str, Path]]): 
             Path to the directory where HRV figures will be saved. 
             A subdirectory for the specific `subject_pair` will be created.
+            Not used (and can be None) if `create_qa_plots` is False.
             
         data_output_dir (Union[str, Path]): 
             Path to the directory where HRV metrics and preprocessed data will be saved.
@@ -263,42 +449,170 @@ def compute_windowed_hrv_across_segments(
             
         create_qa_plots (bool):
             Whether or not to generate QA plots and save them.
+            
+        parallel_segments (bool):
+            Whether to process the segments in (up to 4) parallel threads. Most of the work is done in NumPy/SciPy, 
+            which releases the GIL. Only useful if the CPUs are not already saturated by processing multiple dyads 
+            in parallel. Defaults to False.
+            
+        concatenate_signals (bool):
+            Whether to concatenate the preprocessed data of the segments. If the preprocessed data is not exported, 
+            this can be disabled to save the time and memory. Defaults to True.
     
     Returns:
-        Tuple[pd.DataFrame, pd.DataFrame]: 
+        Tuple[pd.DataFrame, Optional[pd.DataFrame]]: 
             - A DataFrame containing concatenated HRV metrics across all segments.
-            - A DataFrame containing concatenated preprocessed data across all segments.
+            - A DataFrame containing concatenated preprocessed data across all segments, or None if `concatenate_signals` is False.
     """
-    figure_output_dir = Path(figure_output_dir)
+    import utils.nk_pipeline as nk_pipeline # imported lazily, see process_dyad
+
+    figure_output_dir = Path(figure_output_dir) / subject_pair if create_qa_plots else None
     data_output_dir = Path(data_output_dir)
     
-    all_hrv_metrics = []
-    all_preprocessed_data = []
+    segment_names = [segment_df["event_description"].iloc[0] for segment_df in segments_df_list]
 
-    for segment_df in segments_df_list:
-        segment_name = segment_df["event_description"].iloc[0]
+    def process_segment(segment_df: pd.DataFrame, segment_name: str) -> pd.DataFrame:
         hrv_segment_metrics_df = nk_pipeline.calculate_windowed_HRV_metrics(
             segment_df, 
             parameters, 
             export_segment_plot=create_qa_plots,
-            figure_output_dir=figure_output_dir / subject_pair, 
+            figure_output_dir=figure_output_dir, 
             segment_name=segment_name
         )
-        
-        # Add HRV metrics and preprocessed data to lists
-        hrv_segment_metrics_df = hrv_segment_metrics_df.assign(segment_name = segment_name)
-        all_hrv_metrics.append(hrv_segment_metrics_df)
-        segment_df = segment_df.assign(segment_name = segment_name)
-        all_preprocessed_data.append(segment_df)
+        return hrv_segment_metrics_df.assign(segment_name = segment_name)
 
-    # Concatenate all HRV metrics and preprocessed data
+    # Compute the HRV metrics of all segments
+    if parallel_segments and len(segments_df_list) > 1:
+        with ThreadPoolExecutor(max_workers=min(4, len(segments_df_list))) as executor:
+            all_hrv_metrics = list(executor.map(process_segment, segments_df_list, segment_names))
+    else:
+        all_hrv_metrics = [process_segment(segment_df, segment_name) for segment_df, segment_name in zip(segments_df_list, segment_names)]
     concatenated_hrv_metrics = pd.concat(all_hrv_metrics, ignore_index=True)
-    concatenated_preprocessed_data = pd.concat(all_preprocessed_data, ignore_index=True)
+    
+    if not concatenate_signals:
+        return concatenated_hrv_metrics, None
+    
+    # The preprocessed data of all segments is written directly into preallocated columns instead of 
+    # concatenating (copies of) the segments at the end. Float columns (i.e., the ECG samples) are stored 
+    # as float32, which is ample precision for ECG data and halves the memory.
+    segment_lengths = [len(segment_df) for segment_df in segments_df_list]
+    preprocessed_columns = {}
+    for column, dtype in (segments_df_list[0].dtypes.items() if segments_df_list else []):
+        if isinstance(dtype, np.dtype) and dtype.kind == 'f':
+            dtype = np.float32
+        elif not (isinstance(dtype, np.dtype) and dtype.kind in 'biu'):
+            dtype = object
+        preprocessed_columns[column] = np.empty(sum(segment_lengths), dtype=dtype)
+    segment_start = 0
+
+    for segment_df in segments_df_list:
+        segment_stop = segment_start + len(segment_df)
+        for column, values in preprocessed_columns.items():
+            values[segment_start:segment_stop] = segment_df[column].to_numpy()
+        segment_start = segment_stop
+
+    # Concatenate the preprocessed data
+    segment_codes, unique_segment_names = pd.factorize(pd.Index(segment_names))
+    concatenated_preprocessed_data = pd.DataFrame(preprocessed_columns, copy=False).assign(
+        segment_name = pd.Categorical.from_codes(np.repeat(segment_codes, segment_lengths), categories=unique_segment_names)
+    )
 
     return concatenated_hrv_metrics, concatenated_preprocessed_data
         
 
 
+def get_mp_context() -> multiprocessing.context.BaseContext:
+    """
+    Returns the multiprocessing context used for the worker processes. 'forkserver' is used where available (Linux), 
+    such that the workers do not inherit the memory (and the threads) of the parent process, and 'spawn' otherwise.
+
+    Returns:
+        multiprocessing.context.BaseContext: The multiprocessing context.
+    """
+    return multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+def get_dyad_output_dir(output_dir: Union[str, Path], subject_id: int, condition: str, wave: str) -> Path:
+    """
+    Returns the directory in which the outputs (data or QA plots) of a dyad are saved.
+
+    Args:
+        output_dir (Union[str, Path]): The output directory of all dyads (e.g., the processed data directory).
+        subject_id (int): The ID of the dyad.
+        condition (str): The condition of the dyad.
+        wave (str): The wave of the recording.
+
+    Returns:
+        Path: The output directory of the dyad, e.g., output_dir/B_1_W1.
+    """
+    return Path(output_dir) / f"{condition}_{subject_id}_{wave}"
+
+def get_hrv_output_filepaths(data_output_dir: Union[str, Path], subject_id: int, condition: str, wave: str, legacy_xlsx: bool=False) -> Tuple[Path, Path]:
+    """
+    Returns the filepaths of the child and mother HRV metrics of a dyad as saved by `process_dyad`.
+
+    Args:
+        data_output_dir (Union[str, Path]): The output directory of all dyads (i.e., the processed data directory).
+        subject_id (int): The ID of the dyad.
+        condition (str): The condition of the dyad.
+        wave (str): The wave of the recording.
+        legacy_xlsx (bool): Whether the HRV metrics are saved as Excel files instead of Parquet files.
+
+    Returns:
+        Tuple[Path, Path]: The filepaths of the child and the mother HRV metrics.
+    """
+    dyad_output_dir = get_dyad_output_dir(data_output_dir, subject_id, condition, wave)
+    suffix = 'xlsx' if legacy_xlsx else 'parquet'
+    return (
+        dyad_output_dir / f'{condition}{subject_id}_{wave}_child_hrv.{suffix}',
+        dyad_output_dir / f'{condition}{subject_id}_{wave}_mother_hrv.{suffix}'
+    )
+
+def outputs_up_to_date(input_filepath: Union[str, Path], output_filepaths: List[Path]) -> bool:
+    """
+    Checks whether all output files exist and are newer than the input file they were created from.
+
+    Args:
+        input_filepath (Union[str, Path]): The input file (e.g., the ECG recording).
+        output_filepaths (List[Path]): The output files created from the input file.
+
+    Returns:
+        bool: True if all output files exist and none of them is older than the input file.
+    """
+    input_mtime = os.path.getmtime(input_filepath)
+    return all(filepath.is_file() and os.path.getmtime(filepath) >= input_mtime for filepath in output_filepaths)
+
+def add_constant_columns(df: pd.DataFrame, **columns) -> pd.DataFrame:
+    """
+    Adds columns that have the same value for every row (e.g., the subject ID) to a DataFrame.
+
+    The columns are added as categoricals, so every row only stores a 1-byte code instead of a (string) object. 
+    This matters for the long signal DataFrames with millions of rows.
+
+    Args:
+        df (pd.DataFrame): The DataFrame to which the columns are added.
+        **columns: The column names and their (constant) values.
+
+    Returns:
+        pd.DataFrame: A new DataFrame with the added columns.
+
+    Example:
+        >>> df = add_constant_columns(df, subject_type="child", subject_id=1)
+    """
+    codes = np.zeros(len(df), dtype=np.int8)
+    return df.assign(**{
+        name: pd.Categorical.from_codes(codes, categories=[value]) for name, value in columns.items()
+    })
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Preprocess the ECG data and calculate the HRV metrics of all dyads.")
+    parser.add_argument("--legacy-xlsx", action="store_true", 
+                        help="Save the HRV metrics as Excel files and the processed signals as csv files instead of Parquet files.")
+    parser.add_argument("--force", action="store_true", 
+                        help="Also process the dyads whose outputs already exist.")
+    args = parser.parse_args()
+    
     process_all_dyads(
+        legacy_xlsx=args.legacy_xlsx,
+        force=args.force
         )
\ No newline at end of file
@@ -1,6 +1,7 @@
 import pandas as pd
 from pathlib import Path
 import numpy as np
+from numba import njit
 from typing import Union, List
 
 
@@ -29,18 +30,17 @@ def plausible_to_nan(
     pd.DataFrame
         A DataFrame with implausible values in the specified column replaced by NaN.
     """
-    df = df.copy()  # To avoid modifying the original DataFrame
-    df[f"{column}_plausible"] = np.where(
-        (df[column] < lower_bound) | (df[column] > upper_bound), 
-        np.nan, 
-        df[column]
-    )
-    return df
+    # assign returns a new DataFrame, so the original DataFrame is not modified. With Copy-on-Write (default as of
+    # pandas 3) the new DataFrame shares the memory of the existing columns instead of copying them
+    values = df[column].to_numpy(dtype=np.float64)
+    return df.assign(**{
+        f"{column}_plausible": np.where((values < lower_bound) | (values > upper_bound), np.nan, values)
+    })
 
 def identify_outliers_zscore(
     data: Union[List[float], np.ndarray, pd.Series], 
     threshold: float = 1.96
-) -> List[bool]:
+) -> np.ndarray:
     """
     Identify outliers in a dataset based on the Z-score method.
     
@@ -53,33 +53,45 @@ def identify_outliers_zscore(
         
     Returns:
     -------
-    List[bool]
-        A list of booleans indicating whether each value is an outlier (True) or not (False).
+    np.ndarray
+        A boolean array indicating whether each value is an outlier (True) or not (False).
         NaN values are treated as outliers.
     """
     # Convert data to a numpy array
     data_array = np.asarray(data, dtype=np.float64)
     
-    # Identify NaN values (NaN will be treated as outliers)
-    nan_mask = np.isnan(data_array)
-    
-    # Calculate Z-scores only for non-NaN values
-    valid_data = data_array[~nan_mask]
-    mean = valid_data.mean()
-    std = valid_data.std(ddof=0)
-    
-    z_scores = (valid_data - mean) / std
-    outliers_non_nan = np.abs(z_scores) > threshold
-    
-    # Create a boolean array for the entire data, marking NaNs as outliers
-    outliers = np.full(data_array.shape, True)  # Default to True for NaN values
-    outliers[~nan_mask] = outliers_non_nan
-    
-    return outliers.tolist()
+    outliers = np.empty(data_array.shape, dtype=np.bool_)
+    _identify_outliers_zscore_kernel(data_array.ravel(), threshold, outliers.ravel())
+    return outliers
+
+@njit(cache=True)
+def _identify_outliers_zscore_kernel(data_array: np.ndarray, threshold: float, outliers: np.ndarray) -> None:
+    # Compiled kernel of identify_outliers_zscore, writes the result to `outliers` without any temporary arrays.
+    # Note: fastmath is not used since it allows the compiler to assume that there are no NaN values.
+    
+    # Mean and (population) standard deviation of the non-NaN values
+    count = 0
+    total = 0.0
+    for value in data_array:
+        if not np.isnan(value):
+            count += 1
+            total += value
+    mean = total / count if count > 0 else np.nan
+    
+    squared_deviations = 0.0
+    for value in data_array:
+        if not np.isnan(value):
+            squared_deviations += (value - mean) ** 2
+    std = np.sqrt(squared_deviations / count) if count > 0 else np.nan
+    
+    # |z| > threshold <=> |x - mean| > threshold * std. NaN values are treated as outliers
+    limit = threshold * std
+    for i in range(data_array.shape[0]):
+        outliers[i] = np.isnan(data_array[i]) or abs(data_array[i] - mean) > limit
 
 def replace_outliers_zscore(
     data: Union[List[float], np.ndarray, pd.Series], 
-    outliers: List[bool], 
+    outliers: Union[List[bool], np.ndarray], 
     method: str = "median"
 ) -> Union[np.ndarray, pd.Series]:
     """
@@ -89,15 +101,15 @@ def replace_outliers_zscore(
     ----------
     data : Union[List[float], np.ndarray, pd.Series]
         The input data containing original values.
-    outliers : List[bool]
-        A list of booleans indicating whether each value is an outlier (True) or not (False).
+    outliers : Union[List[bool], np.ndarray]
+        A list or array of booleans (e.g., as returned by `identify_outliers_zscore`) indicating whether each value is an outlier (True) or not (False).
     method : str, optional
         The method to replace outliers, either 'median' or 'mean'. Default is 'median'.
         
     Returns:
     -------
     Union[np.ndarray, pd.Series]
-        The dataset with outliers replaced by the specified method's value.
+        A copy of the dataset with outliers replaced by the specified method's value.
     """
     # Convert data to a numpy array for consistent processing
     data_array = np.asarray(data)
@@ -106,12 +118,13 @@ def replace_outliers_zscore(
     if method not in {"median", "mean"}:
         raise ValueError("Invalid method. Use 'median' or 'mean'.")
     
-    # Compute the replacement value based on the specified method
-    non_outliers = data_array[~np.array(outliers)]
+    # Compute the replacement value based on the specified method (np.median uses a partial sort, np.partition)
+    outliers = np.asarray(outliers, dtype=bool)
+    non_outliers = data_array[~outliers]
     replacement_value = np.median(non_outliers) if method == "median" else np.mean(non_outliers)
     
-    # Replace outliers with the calculated value
-    data_array[outliers] = replacement_value
+    # Replace outliers with the calculated value (in a new array, the input data is not modified)
+    data_array = np.where(outliers, replacement_value, data_array)
     
     # Return the modified data in the same type as the input
     if isinstance(data, pd.Series):
@@ -145,34 +158,31 @@ def identify_clean_outliers(
     Returns:
     -------
     pd.DataFrame
-        The original DataFrame with two additional columns:
-        - `{hrv_variable_name}_z_score_outlier`: Boolean column indicating outliers.
-        - `{hrv_variable_name}_imputed`: Column with outliers replaced by the specified method.
+        A copy of the DataFrame with two additional columns:
+        - `{hrv_variable_name}_z_score_outlier`: Boolean column indicating outliers (per segment).
+        - `{hrv_variable_name}_imputed`: Column with outliers replaced by the specified method (per segment).
     """
     # Ensure method is valid
     if method not in {"median", "mean"}:
         raise ValueError("Invalid method. Use 'median' or 'mean'.")
 
-    for segment in df['segment_name'].unique():
-        subset_df = df[df['segment_name'] == segment].copy()
-
-        rmssd_values = subset_df[hrv_variable_name]
-        
-        # Identify outliers
-        subset_df[f'{hrv_variable_name}_z_score_outlier'] = identify_outliers_zscore(rmssd_values, threshold=threshold_z_score)
-        
-        # Replace outliers
-        subset_df[f'{hrv_variable_name}_imputed'] = replace_outliers_zscore(
-            rmssd_values, 
-            subset_df[f'{hrv_variable_name}_z_score_outlier'], 
-            method=method
-        )
-
-        # Update the original DataFrame
-        df.loc[df['segment_name'] == segment, f'{hrv_variable_name}_z_score_outlier'] = subset_df[f'{hrv_variable_name}_z_score_outlier'].values
-        df.loc[df['segment_name'] == segment, f'{hrv_variable_name}_imputed'] = subset_df[f'{hrv_variable_name}_imputed'].values
-
-    return df
+    values = df[hrv_variable_name].to_numpy(dtype=np.float64)
+    
+    # Rows without a segment are left as they are (only NaN values are outliers)
+    outliers = np.isnan(values)
+    imputed = values.copy()
+    
+    # Process the segments using the positions of their rows, which are determined once for all segments
+    for positions in df.groupby('segment_name', sort=False).indices.values():
+        segment_values = values[positions]
+        segment_outliers = identify_outliers_zscore(segment_values, threshold=threshold_z_score)
+        outliers[positions] = segment_outliers
+        imputed[positions] = replace_outliers_zscore(segment_values, segment_outliers, method=method)
+    
+    return df.assign(**{
+        f'{hrv_variable_name}_z_score_outlier': outliers,
+        f'{hrv_variable_name}_imputed': imputed
+    })
 
 def detect_segment_level_outliers(
     df: pd.DataFrame, 
@@ -203,29 +213,18 @@ def detect_segment_level_outliers(
     pd.DataFrame
         Original DataFrame with an additional column 'segment_outlier' indicating segment-level outliers.
     """
-    segment_outliers = []
+    # Statistics per segment (count and std exclude NaN values)
+    segment_stats = df.groupby('segment_name')[hrv_variable_name].agg(['count', 'mean', 'std'])
     
-    for segment in df['segment_name'].unique():
-        segment_data = df[df['segment_name'] == segment][hrv_variable_name]
-        
-        # Exclude NaN values for calculations
-        non_nan_data = segment_data.dropna()
-        
-        # Check if the segment has fewer than min_datapoints_required non-NaN data points
-        if len(non_nan_data) < min_datapoints_required:
-            segment_outliers.extend([True] * len(segment_data))
-            continue
-        
-        # Calculate mean and standard deviation
-        mean = non_nan_data.mean()
-        std = non_nan_data.std()
-        
-        # Calculate Coefficient of Variation
-        cv = std / mean if mean != 0 else np.inf
-        
-        # Determine if the segment is an outlier
-        is_outlier = (cv > cv_threshold) or (std < 0.00001)
-        segment_outliers.extend([is_outlier] * len(segment_data))
+    # Calculate Coefficient of Variation
+    cv = np.where(segment_stats['mean'] != 0, segment_stats['std'] / segment_stats['mean'], np.inf)
+    
+    # Determine if the segments are outliers
+    segment_is_outlier = (
+        (segment_stats['count'] < min_datapoints_required) 
+        | (cv > cv_threshold) 
+        | (segment_stats['std'] < 0.00001)
+    )
     
-    df['segment_outlier'] = segment_outliers
+    df['segment_outlier'] = df['segment_name'].map(segment_is_outlier)
     return df
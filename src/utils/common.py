@@ -9,14 +9,46 @@ import pandas as pd
 from pathlib import Path
 import yaml
 import os
+import re
+import numbers
 import logging
+import logging.handlers
 # fmt: on
 
+# Strings that can be converted by float(): decimal numbers (e.g., '10', '-2.5', '.5', '1e3'), inf, and nan
+NUMBER_PATTERN = re.compile(r'^\s*[+-]?(?:(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?|inf(?:inity)?|nan)\s*$', re.IGNORECASE)
+
+# Use the (much faster) C implementation of the YAML parser/emitter (libyaml) if PyYAML was built with it
+try:
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
+
+# Directories created (or found to exist) by `ensure_dir` in this process
+_ENSURED_DIRS = set()
+
 
 ##########################
 #### COMMON FUNCTIONS ####
 ##########################
 
+def ensure_dir(dir_path: Union[str, Path]) -> Path:
+    """
+    Creates a directory (including its parents) if it does not exist yet. Directories that were already ensured 
+    by this process are remembered, so repeated calls for the same directory do not hit the file system again.
+
+    Args:
+        dir_path (Union[str, Path]): The directory to create.
+
+    Returns:
+        Path: The directory as a Path object.
+    """
+    dir_path = Path(dir_path)
+    if dir_path not in _ENSURED_DIRS:
+        dir_path.mkdir(parents=True, exist_ok=True)
+        _ENSURED_DIRS.add(dir_path)
+    return dir_path
+
 def export_to_yaml(data: Dict[str, Any], output_path: Union[str, Path]) -> None:
     """
     Exports a dictionary to a YAML file at the specified output path.
@@ -33,7 +65,7 @@ def export_to_yaml(data: Dict[str, Any], output_path: Union[str, Path]) -> None:
     output_path = Path(output_path)
     
     with output_path.open('w') as file:
-        yaml.dump(data, file, default_flow_style=False)
+        yaml.dump(data, file, Dumper=YamlDumper, default_flow_style=False)
         
 def load_from_yaml(input_path: Union[str, Path]) -> Dict[str, Any]:
     """
@@ -49,17 +81,27 @@ def load_from_yaml(input_path: Union[str, Path]) -> Dict[str, Any]:
     # Convert input path to Path object if it is a string
     input_path = Path(input_path)
     
-    with input_path.open('r') as file:
-        data = yaml.safe_load(file)
+    # Parameter files are small: read them at once and let libyaml parse the bytes (no file object/stream reads)
+    data = yaml.load(input_path.read_bytes(), Loader=YamlLoader)
     
     return data
 
-def is_number(s):
-    try:
-        float(s)
+def is_number(s: Any) -> bool:
+    """
+    Checks whether a value is a number or a string that represents a number (i.e., can be converted with float()).
+    Uses a regular expression instead of trying float(), which is much faster for the (common) non-numeric strings 
+    such as event names since no exception has to be raised.
+
+    Args:
+        s (Any): The value to check.
+
+    Returns:
+        bool: True if the value is a (real) number or represents one, False otherwise.
+    """
+    if isinstance(s, numbers.Real):
         return True
-    except ValueError:
-        return False
+    return isinstance(s, str) and NUMBER_PATTERN.match(s) is not None
+
 class Logger:
     def __init__(self, name: str, log_level: int = logging.INFO, log_file: str = None) -> None:
         """
@@ -121,3 +163,33 @@ class Logger:
             >>> my_logger.info("Logger is configured and ready to use.")
         """
         return self.logger
+
+def configure_queue_logger(name: str, log_queue: Any, log_level: int = logging.INFO) -> logging.Logger:
+    """
+    Configures a logger that forwards all of its records to a queue instead of writing them itself.
+
+    Meant to be called in worker processes (e.g., as initializer of a process pool). The records are
+    written by a `logging.handlers.QueueListener` in the main process that holds the actual console and
+    file handlers, so that the logs of all workers end up in the same log file.
+
+    Args:
+        name (str): Name of the logger. Should be the same name as the logger of the main process.
+        log_queue (Any): The (multiprocessing) queue to which the log records are sent.
+        log_level (int): Logging level. Default is logging.INFO.
+
+    Returns:
+        logging.Logger: The configured logger instance.
+
+    Example:
+        >>> log_queue = multiprocessing.Queue()
+        >>> listener = logging.handlers.QueueListener(log_queue, *main_logger.handlers)
+        >>> # in the worker process:
+        >>> logger = configure_queue_logger("myApp", log_queue)
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(log_level)
+    # Handlers might have been inherited from the parent process when forking
+    logger.handlers.clear()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.propagate = False
+    return logger
@@ -5,12 +5,29 @@ Data loading functions
 
 # fmt: off
 from typing import Dict, Tuple, Union, List, Optional, Any
+import os
+import re
+import functools
+import importlib.util
 import warnings
+import numpy as np
 import pandas as pd
 from pathlib import Path
 import utils.common as common
 # fmt: on
 
+# Matches ECG recordings (e.g., B01_W1_mc.txt) and event files (e.g., B01_W1_event.txt). 
+# The first group is the part of the name shared by a recording and its event file.
+ECG_EVENT_FILENAME_PATTERN = re.compile(r'(.*?)(mc|event)\.txt$')
+
+# Columns of the prepared ECG data stored in the .npy cache of an ECG recording (see `load_ecg_data`). 
+# The cache is a (1 + n_columns, n_samples) float64 array: the time index ('seconds') followed by these columns
+# (which are float32 after `prepare_ecg_data`, and are therefore stored exactly).
+ECG_CACHE_COLUMNS = ('child_ecg', 'mother_ecg')
+
+# The multithreaded pyarrow csv parser is several times faster for the (large) ECG files, but pyarrow is optional
+ECG_CSV_ENGINE = 'pyarrow' if importlib.util.find_spec('pyarrow') is not None else 'c'
+
 
 
 ################################################
@@ -26,6 +43,11 @@ def load_dyad_ecg_events(filepath_ecg: Union[str, Path], filepath_events: Union[
     index. The resulting DataFrame contains the ECG signal data along 
     with associated event information.
 
+    Rather than a (hash) merge of the few events with the millions of ECG 
+    samples, the row position of each event is looked up in the time index 
+    of the ECG data, and the event columns are created directly from these 
+    positions as pandas Categoricals. The ECG columns are not copied.
+
     Parameters:
     ----------
     filepath_ecg : Union[str, Path]
@@ -40,26 +62,35 @@ def load_dyad_ecg_events(filepath_ecg: Union[str, Path], filepath_events: Union[
     -------
     pd.DataFrame
         A DataFrame containing the merged ECG and event data, indexed 
-        by the timestamps of the ECG data.
+        by the timestamps of the ECG data. The `event` and `event_description` 
+        columns are returned as pandas Categoricals (NaN for samples without 
+        an event).
 
     Raises:
     ------
     FileNotFoundError
         If either of the provided file paths does not exist.
-    ValueError
-        If the data cannot be merged due to incompatible indices.
+    pd.errors.InvalidIndexError
+        If the time index of the ECG data contains duplicates.
     """
     # Load datasets
     event_df = load_event_data(filepath_events)
     ecg_df = load_ecg_data(filepath_ecg)
-    # Left-join the events on the signal data
-    merged_df = ecg_df.merge(
-        event_df.set_index("timestamp_ms"), 
-        left_index=True, 
-        right_index=True, 
-        how='left'
-    )
-    return merged_df
+    
+    # Left-join the events on the signal data: events with a time stamp that is not in the ECG data are dropped
+    event_positions = ecg_df.index.get_indexer(event_df["timestamp_ms"])
+    matched_events = event_positions >= 0
+    event_positions = event_positions[matched_events]
+    if len(np.unique(event_positions)) < len(event_positions):
+        warnings.warn(f"Multiple events at the same time stamp in {Path(filepath_events).name}. Only the last of them is kept.")
+    
+    for column in ["event", "event_description"]:
+        # Few distinct events repeated over millions of rows -> store them as a categorical
+        event_codes, event_categories = pd.factorize(event_df[column].to_numpy()[matched_events])
+        codes = np.full(len(ecg_df), -1, dtype=np.int16)
+        codes[event_positions] = event_codes
+        ecg_df[column] = pd.Categorical.from_codes(codes, categories=event_categories)
+    return ecg_df
 
 def prepare_ecg_data(df: pd.DataFrame) -> pd.DataFrame:
     """
@@ -69,6 +100,12 @@ def prepare_ecg_data(df: pd.DataFrame) -> pd.DataFrame:
     'seconds', 'child_ecg', and 'mother_ecg' respectively. It also sets the 'seconds' 
     column as the index of the DataFrame.
 
+    The ECG signals are down-cast to float32, which halves their memory (bandwidth) in all 
+    subsequent processing steps. float32 has a precision of ~7 significant digits, which is 
+    ample for the (at most 24 bit) resolution of the ECG amplifier. The 'seconds' index is 
+    deliberately kept as float64: the events are joined on exact matches of the time stamps, 
+    and float32 cannot represent the time stamps of long recordings exactly (e.g., 3600.002 s).
+
     Args:
         df (pd.DataFrame): The input DataFrame containing columns 'Time (s)', 'MWCHILD_Bio', 
             and 'MOTHER_Bio'.
@@ -81,6 +118,8 @@ def prepare_ecg_data(df: pd.DataFrame) -> pd.DataFrame:
     """
     df = df.rename(columns={'Time (s)': 'seconds', 'MWCHILD_Bio': 'child_ecg', 'MOTHER_Bio': 'mother_ecg'}, errors='raise')
     df = df.set_index("seconds")
+    for column in ('child_ecg', 'mother_ecg'):
+        df[column] = df[column].astype(np.float32, copy=False)
     return df
 
 def split_in_child_mother_series(df: pd.DataFrame) -> Tuple[pd.Series, pd.Series]:
@@ -101,23 +140,51 @@ def split_in_child_mother_series(df: pd.DataFrame) -> Tuple[pd.Series, pd.Series
     Raises:
         KeyError: If 'child_ecg' or 'mother_ecg' columns are missing in the input DataFrame.
     """
-    child_ecg = df['child_ecg']
-    child_ecg.index = df.index
-    mother_ecg = df['mother_ecg']
-    mother_ecg.index = df.index
-    
-    return child_ecg, mother_ecg
+    # The columns already share the index of the DataFrame
+    return df['child_ecg'], df['mother_ecg']
+
+def add_event_columns(signals_df: pd.DataFrame, events_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Adds the event columns (e.g., 'event' and 'event_description') of the loaded ECG and event data to 
+    the preprocessed signals of a subject.
+
+    The preprocessed signals keep the time index of the loaded data, so the columns are assigned directly 
+    instead of joining them with a (much slower) left merge on the index.
+
+    Args:
+        signals_df (pd.DataFrame): The preprocessed signals, e.g., as returned by `nk_pipeline.ecg_preprocess`.
+        events_df (pd.DataFrame): The event columns of the loaded data (see `load_dyad_ecg_events`), 
+            with the same index as `signals_df`.
+
+    Returns:
+        pd.DataFrame: A copy of `signals_df` with the event columns added.
 
-def load_ecg_data(file_path: Union[str, Path]) -> Tuple[pd.Series, pd.Series]:
+    Raises:
+        ValueError: If the lengths or the indexes of the DataFrames do not match.
     """
-    Loads and processes data from a specified file, returning separated ECG 
-    series for child and mother.
+    if len(signals_df) != len(events_df):
+        raise ValueError(f"Length of the signals ({len(signals_df)}) does not match the length of the events ({len(events_df)}).")
+    if not signals_df.index.equals(events_df.index):
+        raise ValueError("The index of the signals does not match the index of the events.")
+    return signals_df.assign(**{column: events_df[column].array for column in events_df.columns})
+
+def load_ecg_data(file_path: Union[str, Path], use_cache: bool=True) -> pd.DataFrame:
+    """
+    Loads and prepares the ECG data of a dyad from a specified file (see `prepare_ecg_data`).
+
+    Parsing the text file is slow, so the prepared data is cached in a .npy file next to it 
+    (e.g., B01_W1_mc.txt -> B01_W1_mc.npy) the first time it is read. Afterwards the data is 
+    memory-mapped from the cache: the time index is used directly from the mapped file, and since 
+    the child and mother channels are stored contiguously, each of them is read (and converted to 
+    float32) with a single sequential read. The cache is recreated when the text file is newer than the cache.
 
     Args:
         file_path (Union[str, Path]): The file path to the data file (tab-separated format).
+        use_cache (bool, optional): Whether to use (and create) the .npy cache. Defaults to True.
     
     Returns:
-        Tuple[pd.Series, pd.Series]: A tuple containing the child data series and mother data series.
+        pd.DataFrame: The ECG data with the columns 'child_ecg' and 'mother_ecg' and 'seconds' as the index.
+            The ECG signals are float32 (see `prepare_ecg_data`). The index is read-only if it is loaded from the cache.
     
     Raises:
         FileNotFoundError: If the file does not exist at the specified path.
@@ -125,12 +192,87 @@ def load_ecg_data(file_path: Union[str, Path]) -> Tuple[pd.Series, pd.Series]:
     
     Notes:
         - The data file should be in tab-separated format.
+        - Only the columns in `ECG_CACHE_COLUMNS` are cached. If the cache cannot be written 
+          (e.g., a read-only data directory), the data is returned without caching it.
+    """
+    file_path = Path(file_path)
+    cache_path = file_path.with_suffix('.npy')
+    if not use_cache:
+        return prepare_ecg_data(read_ecg_file(file_path))
+
+    if not cache_path.exists() or cache_path.stat().st_mtime < file_path.stat().st_mtime:
+        df = prepare_ecg_data(read_ecg_file(file_path))
+        try:
+            # Write to a temporary file first, such that an interrupted write never leaves a corrupt cache behind
+            tmp_cache_path = cache_path.with_suffix('.npy.tmp')
+            with tmp_cache_path.open('wb') as file:
+                np.save(file, np.vstack([df.index.to_numpy(dtype=np.float64), *(df[column].to_numpy(dtype=np.float64) for column in ECG_CACHE_COLUMNS)]))
+            os.replace(tmp_cache_path, cache_path)
+        except OSError as e:
+            warnings.warn(f"Could not cache the ECG data of {file_path.name}: {e}")
+            return df
+        del df
+
+    data = np.load(cache_path, mmap_mode='r')
+    return pd.DataFrame(
+        {column: data[i + 1].astype(np.float32) for i, column in enumerate(ECG_CACHE_COLUMNS)},
+        index=pd.Index(data[0], name='seconds'),
+        copy=False
+    )
+
+def read_ecg_file(file_path: Union[str, Path]) -> pd.DataFrame:
+    """
+    Reads an ECG recording (tab-separated text file) as is, using the pyarrow parser if pyarrow is installed.
+
+    Args:
+        file_path (Union[str, Path]): The file path to the data file (tab-separated format).
+
+    Returns:
+        pd.DataFrame: The raw data with the columns of the file (e.g., 'Time (s)', 'MOTHER_Bio', 'MWCHILD_Bio').
     """
+    # The first line contains the sample rate, the column names are in the second line. Note that `header=1` is 
+    # used instead of `skiprows=1` since the pyarrow engine skips the rows after (instead of before) the header.
+    return pd.read_csv(file_path, sep='\t', header=1, engine=ECG_CSV_ENGINE)
+
+def find_ecg_event_filepaths(data_dir: Union[str, Path]) -> Tuple[List[Path], List[Path]]:
+    """
+    Finds all ECG recordings (files ending with 'mc.txt') in a directory together with their event files 
+    (files ending with 'event.txt').
+
+    The directory is scanned only once. The event file of a recording is found by the part of the name 
+    in front of 'mc'/'event' (e.g., B01_W1_mc.txt -> B01_W1_event.txt) rather than by sorting both lists 
+    of files, so a missing or extra file can never shift the pairs. Recordings without an event file 
+    and event files without a recording are skipped with a warning.
+
+    Args:
+        data_dir (Union[str, Path]): The directory containing the ECG recordings and event files.
+
+    Returns:
+        Tuple[List[Path], List[Path]]: Two lists of equal length with the sorted ECG filepaths and 
+            the corresponding event filepaths.
+    """
+    ecg_filenames = {}
+    event_filenames = {}
+    for entry in os.scandir(data_dir):
+        match = ECG_EVENT_FILENAME_PATTERN.match(entry.name)
+        if match is None:
+            continue
+        prefix, file_type = match.groups()
+        (ecg_filenames if file_type == 'mc' else event_filenames)[prefix] = entry.name
     
-    df = pd.read_csv(file_path, sep='\t', skiprows=1)
-    df = prepare_ecg_data(df)
-    # child_series, mother_series = split_in_child_mother_series(df)
-    return df #child_series, mother_series
+    for prefix in sorted(event_filenames.keys() - ecg_filenames.keys()):
+        warnings.warn(f"No ECG file found for event file {event_filenames[prefix]}. Skipping it.")
+    
+    ecg_filepaths = []
+    event_filepaths = []
+    for prefix in sorted(ecg_filenames):
+        if prefix not in event_filenames:
+            warnings.warn(f"No event file found for ECG file {ecg_filenames[prefix]}. Skipping it.")
+            continue
+        ecg_filepaths.append(Path(data_dir) / ecg_filenames[prefix])
+        event_filepaths.append(Path(data_dir) / event_filenames[prefix])
+    
+    return ecg_filepaths, event_filepaths
 
 def extract_subject_id_condition_from_filepath(file_path: Union[str, Path]) -> Tuple[int, str]:
     """
@@ -153,9 +295,14 @@ def extract_subject_id_condition_from_filepath(file_path: Union[str, Path]) -> T
         For a file path with the file name "C123_data.txt", this function extracts:
             - condition = "C"
             - subject_id = "123"
+
+    Notes:
+        The results are cached per file name (without extension), so repeated calls for the same file are cheap.
     """
-    file_path = Path(file_path)
-    file_name = file_path.stem
+    return _extract_subject_id_condition_from_filename(os.path.splitext(os.path.basename(file_path))[0])
+
+@functools.lru_cache(maxsize=None)
+def _extract_subject_id_condition_from_filename(file_name: str) -> Tuple[int, str, str]:
     condition_subject_wave_type_string = file_name.split('_')
     assert len(condition_subject_wave_type_string) == 3, f"Error parsing file {file_name}. File should be of format B01_W1_event.txt or B01_W1_mc.txt"
     condition = (condition_subject_wave_type_string[0][0]).upper() # first element = condition letter
@@ -164,7 +311,7 @@ def extract_subject_id_condition_from_filepath(file_path: Union[str, Path]) -> T
     file_type = condition_subject_wave_type_string[-1]
     
     assert len(condition) == 1
-    assert len(wave) == 2, f"Error: wave should be 2 letters/digits but is {len(wave)} in file {file_path}"
+    assert len(wave) == 2, f"Error: wave should be 2 letters/digits but is {len(wave)} in file {file_name}"
     assert ('mc' in file_type) or ('event' in file_type)
    
     return subject_id, condition, wave
@@ -199,7 +346,7 @@ def prepare_event_data(df: pd.DataFrame) -> pd.DataFrame:
     assert 'Acquisition Start' in df.columns, "Acquisition Start column not found in the event file."
     assert df.shape[1] == 3, "Event file should have 3 columns."
     df.columns = ['event', 'event_description', 'timestamp_ms']
-    df['event_description'] = df['event_description'].apply(lambda x: x.strip())
+    df['event_description'] = df['event_description'].str.strip()
     
     return df
 
@@ -210,22 +357,45 @@ def prepare_event_data(df: pd.DataFrame) -> pd.DataFrame:
 #### SEGMENTATION FUNCTIONS ####
 ################################
 
-def get_event_time_from_dataframe_index(event: Union[str, float], df: pd.DataFrame) -> float:
-    """Note that df must have ms as time index"""
+def get_event_times(df: pd.DataFrame) -> Dict[str, List[float]]:
+    """
+    Collects the times (index values) of all events in a DataFrame in a single pass.
+
+    Args:
+        df (pd.DataFrame): DataFrame with an 'event_description' column and the time as index.
+
+    Returns:
+        Dict[str, List[float]]: The times at which each event description occurs.
+    """
     assert 'event_description' in df.columns 
+    event_rows = df['event_description'].notna().to_numpy()
+    event_times = {}
+    for event_description, event_time in zip(df['event_description'].to_numpy()[event_rows], df.index[event_rows]):
+        event_times.setdefault(event_description, []).append(event_time)
+    return event_times
+
+def get_event_time_from_dataframe_index(event: Union[str, float], df: Union[pd.DataFrame, Dict[str, List[float]]]) -> float:
+    """Note that df must have ms as time index. 
+    Instead of the DataFrame, the event times as returned by `get_event_times` can be passed, which avoids 
+    scanning the whole DataFrame for every event."""
     if (isinstance(event, str)):
         if common.is_number(event):
             return float(event)
-        row = df[df['event_description'] == event]
-        if len(row) == 1:
-            return row.index[0]
+        event_times = get_event_times(df) if isinstance(df, pd.DataFrame) else df
+        times = event_times.get(event, [])
+        if len(times) == 1:
+            return times[0]
         else:
-            raise ValueError(f"Found {len(row)} rows in df for event: {event}")
+            raise ValueError(f"Found {len(times)} rows in df for event: {event}")
     elif isinstance(event, float):
         return event
 
 def segment_df(df: pd.DataFrame, pipeline_params: Dict) -> List[pd.DataFrame]:
     segments = []
+    event_times = get_event_times(df)
+    # The time index is sorted, so the segment bounds can be found with a binary search instead of comparing the whole index
+    assert df.index.is_monotonic_increasing, "The time index of the DataFrame must be sorted in ascending order."
+    time_index = df.index.to_numpy()
     for segment_info in pipeline_params['segmentation'].items():
         # Extract the information from the dictionary. 
         segment_name = segment_info[0]
@@ -235,11 +405,12 @@ def segment_df(df: pd.DataFrame, pipeline_params: Dict) -> List[pd.DataFrame]:
             event_offset = float(event_offset)
         
         # get the onset and offset times
-        event_onset_time = get_event_time_from_dataframe_index(event_onset, df)
+        event_onset_time = get_event_time_from_dataframe_index(event_onset, event_times)
         event_offset_time = event_onset_time + event_offset - 1/pipeline_params['general']['sampling_frequency']
         
-        # retrieve the data in between (inclusive bounds) the onset and offset time using the index
-        segment = df[(df.index >= event_onset_time) & (df.index < event_offset_time)]
+        # retrieve the data in between the onset (inclusive) and offset (exclusive) time using the index
+        segment_start, segment_stop = np.searchsorted(time_index, [event_onset_time, event_offset_time], side='left')
+        segment = df.iloc[segment_start:segment_stop]
         if segment.empty:
             warnings.warn(f"Segment {segment_name} is empty between {event_onset_time} and {event_offset_time} ms. Please check the event indices.")
             continue
@@ -4,20 +4,36 @@ It essentially wraps NeuroKit2 functions
 """
 
 # fmt: off
-from typing import Dict, Tuple, Union, List, Optional
+from typing import Dict, Tuple, Union, List, Optional, Iterator
 import neurokit2 as nk
 import pandas as pd
 import numpy as np
+from numba import njit
 from pathlib import Path
 import utils.plot_utils as plot_utils
 # fmt: on
 
+# Minimum number of R-peaks (i.e., at least three RR intervals) in an analysis window to compute HRV metrics
+MIN_PEAKS_PER_WINDOW = 4
+# Columns that describe the analysis window in the output of `calculate_windowed_HRV_metrics`
+WINDOW_COLUMNS = ['start_index', 'stop_index', 'analysis_window', 'heart_rate_bpm']
+# Default settings of the frequency-domain HRV metrics (see `calculate_hrv_indices`)
+_FREQ_DEFAULTS = {
+    'ulf': [0, 0.0033],
+    'vlf': [0.0033, 0.04],
+    'lf': [0.04, 0.15],
+    'hf': [0.15, 0.4],
+    'vhf': [0.4, 0.5],
+    'psd_method': 'welch',
+    'normalize': True,
+}
+
 
 ####################################################
 ##### ECG PREPROCESSING AND ANALSYSIS FUNCTIONS ####
 ####################################################
 
-def clean_ecg(ecg_raw_series: pd.Series, parameters: Dict, **kwargs) -> pd.Series:
+def clean_ecg(ecg_raw_series: pd.Series, parameters: Dict, **kwargs) -> np.ndarray:
     """
     Cleans the ECG signal using NeuroKit2's `ecg_clean` function based on the provided parameters.
 
@@ -31,29 +47,26 @@ def clean_ecg(ecg_raw_series: pd.Series, parameters: Dict, **kwargs) -> pd.Serie
         **kwargs: Additional method-specific parameters for `ecg_clean`.
 
     Returns:
-        pd.Series: The cleaned ECG signal as a pandas Series.
+        np.ndarray: The cleaned ECG signal as a numpy array (of the same length as the raw signal). It is not wrapped 
+            in a pandas Series, since the caller typically only needs the values (e.g., to build a DataFrame).
     """
     if not isinstance(ecg_raw_series, pd.Series):
         raise ValueError("The 'ecg_raw_series' argument must be a pandas Series.")
     
-    cleaned_series = pd.Series(
-        nk.ecg_clean(
-            ecg_raw_series, 
-            sampling_rate=parameters['general'].get('sampling_frequency', 500), 
-            method=parameters['cleaning'].get('method', 'neurokit'),
-            powerline=parameters['cleaning'].get('powerline', 50),  # Optional powerline filtering
-            **kwargs  # additional method-specific parameters
-        )
+    return nk.ecg_clean(
+        ecg_raw_series, 
+        sampling_rate=parameters['general'].get('sampling_frequency', 500), 
+        method=parameters['cleaning'].get('method', 'neurokit'),
+        powerline=parameters['cleaning'].get('powerline', 50),  # Optional powerline filtering
+        **kwargs  # additional method-specific parameters
     )
-    cleaned_series.name = 'ECG_Clean'
-    return cleaned_series
 
-def find_peaks(ecg_cleaned_series: pd.Series, parameters: Dict, **kwargs) -> Tuple[pd.DataFrame, dict]:
+def find_peaks(ecg_cleaned_series: Union[pd.Series, np.ndarray], parameters: Dict, **kwargs) -> Tuple[pd.DataFrame, dict]:
     """
     Detects R-peaks in a cleaned ECG signal using NeuroKit2's `ecg_peaks` function based on the provided parameters.
 
     Args:
-        ecg_cleaned_series (pd.Series): The cleaned ECG signal as a pandas Series.
+        ecg_cleaned_series (Union[pd.Series, np.ndarray]): The cleaned ECG signal, e.g., as returned by `clean_ecg`.
         parameters (dict): A dictionary containing the peak detection parameters. Expected keys:
             - 'sampling_frequency' (int): The sampling frequency of the ECG data.
             - 'peak_detection' (dict): A dictionary with the peak detection method and artifact correction settings.
@@ -101,7 +114,9 @@ def calculate_heartrate(peak_df: pd.DataFrame, parameters: Dict) -> float:
 
     sampling_frequency = parameters['general'].get('sampling_frequency', 500)
     signal_length_seconds = len(peak_df) / sampling_frequency
-    peak_count = peak_df['ECG_R_Peaks'].sum()
+    # The peaks are marked with 1 (and 0 otherwise), so counting the nonzero values on the array 
+    # is equivalent to the (slower) pandas sum
+    peak_count = np.count_nonzero(peak_df['ECG_R_Peaks'].to_numpy())
     
     # Calculate the average heart rate in beats per minute (BPM)
     return (60 / signal_length_seconds) * peak_count
@@ -130,7 +145,15 @@ def calculate_signal_quality(ecg_cleaned_series: pd.Series, rpeaks: Optional[Uni
         Union[np.array, str]: 
             - If the "averageQRS" method is used, returns a vector of quality indices ranging from 0 to 1.
             - If the "zhao2018" method is used, returns a string classification of the signal quality: "Unacceptable", "Barely acceptable", or "Excellent".
+            If fewer than two R-peaks are given (e.g., for a flat signal), the quality is not computed and the lowest quality 
+            is returned (a vector of zeros or "Unacceptable").
     """
+    # Without (at least two) R-peaks, there are no QRS segments to assess
+    if rpeaks is not None and len(rpeaks) < 2:
+        if parameters['signal_quality_index'].get('method', 'averageQRS') == 'averageQRS':
+            return np.zeros(len(ecg_cleaned_series), dtype=np.float32)
+        return "Unacceptable"
+    
     signal_quality_array = nk.ecg_quality(
         ecg_cleaned=ecg_cleaned_series,
         rpeaks=rpeaks,
@@ -141,7 +164,7 @@ def calculate_signal_quality(ecg_cleaned_series: pd.Series, rpeaks: Optional[Uni
     
     return signal_quality_array
 
-def calculate_hrv_indices(peak_df: pd.DataFrame, parameters: Dict) -> pd.DataFrame:
+def calculate_hrv_indices(peak_df: Union[pd.DataFrame, np.ndarray], parameters: Dict) -> pd.DataFrame:
     """
     Calculates heart rate variability (HRV) indices from R-peak data using NeuroKit2's `hrv` functions.
 
@@ -150,9 +173,9 @@ def calculate_hrv_indices(peak_df: pd.DataFrame, parameters: Dict) -> pd.DataFra
     for customized sampling frequency and optional computation of frequency-domain metrics.
 
     Args:
-        peak_df (pd.DataFrame): A DataFrame containing R-peak information, such as indices of peaks or
-            results from functions like `ecg_peaks()` or `ppg_peaks()`. It may also include R-R intervals
-            (RRI) and timestamps (RRI_Time).
+        peak_df (Union[pd.DataFrame, np.ndarray]): A DataFrame containing R-peak information, such as the 
+            results from functions like `ecg_peaks()` or `ppg_peaks()`, or an array with the sample indices of the peaks. 
+            It may also include R-R intervals (RRI) and timestamps (RRI_Time).
         parameters (Dict): A dictionary specifying calculation settings. Expected keys include:
             - 'sampling_frequency' (int): Sampling frequency of the signal in Hz. Defaults to 500 Hz.
             - 'compute_hrv_frequency_metrics' (bool): Flag indicating whether to compute frequency-domain metrics.
@@ -188,34 +211,151 @@ def calculate_hrv_indices(peak_df: pd.DataFrame, parameters: Dict) -> pd.DataFra
         - Frasch (2022). "Advanced HRV analysis in signal processing."
 
     """
-    hrv_time = nk.hrv_time(
+    return pd.DataFrame([_calculate_hrv_indices(
         peak_df,
-        sampling_rate=parameters['general'].get('sampling_frequency', 500),
-        show=False
-    )
+        sampling_frequency=parameters['general'].get('sampling_frequency', 500),
+        frequency_settings=_get_hrv_frequency_settings(parameters)
+    )])
+
+def _get_hrv_frequency_settings(parameters: Dict) -> Optional[Dict]:
+    """
+    Looks up the settings of the frequency-domain HRV metrics in the parameters (see `calculate_hrv_indices`), 
+    such that they can be looked up once instead of per analysis window.
+
+    Args:
+        parameters (Dict): A dictionary specifying calculation settings.
+
+    Returns:
+        Optional[Dict]: The keyword arguments for `nk.hrv_frequency`, or None if the frequency-domain metrics 
+            are not computed.
+    """
+    if not parameters['general'].get("compute_hrv_frequency_metrics", False):
+        return None
     
-    if parameters['general'].get("compute_hrv_frequency_metrics", False):
-        hrv_frequency = nk.hrv_frequency(
-            peak_df,
-            sampling_rate=parameters['general'].get('sampling_frequency', 500),
-            ulf=parameters['hrv_frequency_settings'].get('ulf', [0, 0.0033]),
-            vlf=parameters['hrv_frequency_settings'].get('vlf', [0.0033, 0.04]),
-            lf=parameters['hrv_frequency_settings'].get('lf', [0.04, 0.15]),
-            hf=parameters['hrv_frequency_settings'].get('hf', [0.15, 0.4]),
-            vhf=parameters['hrv_frequency_settings'].get('vhf', [0.4, 0.5]),
-            psd_method=parameters['hrv_frequency_settings'].get('psd_method', 'welch'),
-            normalize=parameters['hrv_frequency_settings'].get('normalize', True),
+    frequency_settings = parameters.get('hrv_frequency_settings', _FREQ_DEFAULTS)
+    return {key: frequency_settings.get(key, default) for key, default in _FREQ_DEFAULTS.items()}
+
+def _calculate_hrv_indices(peaks: Union[pd.DataFrame, np.ndarray], sampling_frequency: int, frequency_settings: Optional[Dict], 
+                           compute_all_time_metrics: bool=True) -> Dict[str, float]:
+    """
+    Calculates the HRV indices with the already looked up parameters. See `calculate_hrv_indices`.
+
+    Args:
+        peaks (Union[pd.DataFrame, np.ndarray]): The R-peaks, see `calculate_hrv_indices`. Must be an array of 
+            sample indices if `compute_all_time_metrics` is False.
+        sampling_frequency (int): Sampling frequency of the signal in Hz.
+        frequency_settings (Optional[Dict]): The keyword arguments for `nk.hrv_frequency` as returned by 
+            `_get_hrv_frequency_settings`, or None to only compute the time-domain metrics.
+        compute_all_time_metrics (bool): Whether to compute all time-domain metrics of `nk.hrv_time`, or only the 
+            basic ones of `_calculate_basic_hrv_time_metrics` (which is much faster). Defaults to True.
+
+    Returns:
+        Dict[str, float]: The HRV indices by name (e.g., 'HRV_RMSSD').
+    """
+    if compute_all_time_metrics:
+        hrv_indices = nk.hrv_time(
+            peaks,
+            sampling_rate=sampling_frequency,
             show=False
+        ).iloc[0].to_dict()
+    else:
+        hrv_indices = _calculate_basic_hrv_time_metrics(peaks, sampling_frequency)
+    
+    if frequency_settings is not None:
+        hrv_frequency = nk.hrv_frequency(
+            peaks,
+            sampling_rate=sampling_frequency,
+            show=False,
+            **frequency_settings
         )
-        return pd.concat([hrv_time, hrv_frequency], axis=1)
+        hrv_indices.update(hrv_frequency.iloc[0].to_dict())
+    
+    return hrv_indices
+
+def _calculate_basic_hrv_time_metrics(peaks: np.ndarray, sampling_frequency: int) -> Dict[str, float]:
+    """
+    Calculates the basic time-domain HRV metrics with a compiled kernel (see `_time_hrv`). `nk.hrv_time` computes 
+    many more metrics (e.g., the geometrical ones) and has considerable overhead per call, which adds up over many 
+    analysis windows. The metrics are defined (and named) the same as in `nk.hrv_time`, but may differ from it in 
+    the last digits due to the different order of the summations.
+
+    Args:
+        peaks (np.ndarray): The sample indices of the R-peaks.
+        sampling_frequency (int): Sampling frequency of the signal in Hz.
+
+    Returns:
+        Dict[str, float]: The metrics 'HRV_MeanNN', 'HRV_SDNN', 'HRV_RMSSD', 'HRV_SDSD', 'HRV_CVNN', 'HRV_CVSD', 
+            'HRV_MedianNN', 'HRV_pNN50', 'HRV_pNN20', 'HRV_MinNN', and 'HRV_MaxNN'. The RR intervals are in milliseconds.
+    """
+    rri = np.diff(peaks) / sampling_frequency * 1000
+    mean_nn, sdnn, rmssd, sdsd, median_nn, min_nn, max_nn, pnn50, pnn20 = _time_hrv(rri)
+    return {
+        'HRV_MeanNN': mean_nn,
+        'HRV_SDNN': sdnn,
+        'HRV_RMSSD': rmssd,
+        'HRV_SDSD': sdsd,
+        'HRV_CVNN': sdnn / mean_nn,
+        'HRV_CVSD': rmssd / mean_nn,
+        'HRV_MedianNN': median_nn,
+        'HRV_pNN50': pnn50,
+        'HRV_pNN20': pnn20,
+        'HRV_MinNN': min_nn,
+        'HRV_MaxNN': max_nn,
+    }
+
+@njit(cache=True, nogil=True)
+def _time_hrv(rri: np.ndarray) -> Tuple[float, float, float, float, float, float, float, float, float]:
+    # Compiled kernel of _calculate_basic_hrv_time_metrics. Computes the metrics of the RR intervals (in ms, without NaN) 
+    # in two passes without any temporary arrays (apart from the sorted copy for the median): the first pass for the 
+    # sums and the extremes, the second one for the deviations from the means (which is more accurate than a single pass).
+    # Note: fastmath is not used since it allows the compiler to assume that there are no NaN values.
+    # The GIL is released, such that segments that are processed in parallel threads (see `parallel_segments` in 
+    # analyse_we_love_reading.py) do not block each other in the kernel.
+    n = rri.shape[0]
+    if n == 0:
+        return np.nan, np.nan, np.nan, np.nan, np.nan, np.nan, np.nan, np.nan, np.nan
+    
+    total = 0.0
+    diff_total = 0.0
+    squared_diff_total = 0.0
+    min_nn = rri[0]
+    max_nn = rri[0]
+    nn50 = 0
+    nn20 = 0
+    for i in range(n):
+        min_nn = min(min_nn, rri[i])
+        max_nn = max(max_nn, rri[i])
+        total += rri[i]
+        if i > 0:
+            diff = rri[i] - rri[i - 1]
+            diff_total += diff
+            squared_diff_total += diff * diff
+            nn50 += abs(diff) > 50
+            nn20 += abs(diff) > 20
+    mean_nn = total / n
+    mean_diff = diff_total / (n - 1) if n > 1 else np.nan
     
-    return hrv_time
+    squared_deviations = 0.0
+    squared_diff_deviations = 0.0
+    for i in range(n):
+        squared_deviations += (rri[i] - mean_nn) ** 2
+        if i > 0:
+            squared_diff_deviations += (rri[i] - rri[i - 1] - mean_diff) ** 2
+    
+    # Sample standard deviations (ddof=1) as in NeuroKit2
+    sdnn = np.sqrt(squared_deviations / (n - 1)) if n > 1 else np.nan
+    rmssd = np.sqrt(squared_diff_total / (n - 1)) if n > 1 else np.nan
+    sdsd = np.sqrt(squared_diff_deviations / (n - 2)) if n > 2 else np.nan
+    # Note that NeuroKit2 divides the counts by the number of RR intervals (rather than the number of differences)
+    pnn50 = nn50 / n * 100
+    pnn20 = nn20 / n * 100
+    return mean_nn, sdnn, rmssd, sdsd, np.median(rri), min_nn, max_nn, pnn50, pnn20
 
 def calculate_windowed_HRV_metrics(
     signals_df: pd.DataFrame, 
     parameters: Dict, 
     export_segment_plot: bool = False, 
-    figure_output_dir: Union[Path, str] = Path().cwd()/"segment_figures",
+    figure_output_dir: Optional[Union[Path, str]] = Path().cwd()/"segment_figures",
     segment_name: str = ""
 ) -> pd.DataFrame:
     """
@@ -231,8 +371,11 @@ def calculate_windowed_HRV_metrics(
             - 'general': A dictionary with general parameters like:
                 - 'analysis_window_seconds': Duration of the analysis window in seconds.
                 - 'sampling_frequency': Sampling frequency of the ECG signal.
+                - 'compute_all_time_metrics' (optional): Whether to compute all time-domain metrics of NeuroKit2 (default), 
+                  or only the basic ones (e.g., HRV_MeanNN, HRV_SDNN, HRV_RMSSD, HRV_pNN50), which is much faster.
         export_segment_plot (bool, optional): If True, will save a plot of each ECG segment. Default is False.
-        figure_output_dir (Union[Path, str], optional): Directory where segment plots will be saved if `export_segment_plot` is True. Default is 'segment_figures' in the current working directory.
+        figure_output_dir (Optional[Union[Path, str]], optional): Directory where segment plots will be saved if `export_segment_plot` is True. Default is 'segment_figures' in the current working directory.
+            Not used (and can be None) if `export_segment_plot` is False.
 
     Raises:
         ValueError: If the required columns are missing from the input DataFrame.
@@ -243,8 +386,46 @@ def calculate_windowed_HRV_metrics(
             - 'stop_index': Stop index of the analysis window.
             - 'analysis_window': Window count (integer).
             - 'heart_rate_bpm': Calculated heart rate in beats per minute.
-            - Other calculated HRV metrics depending on the implementation of `calculate_hrv_indices`.
+            - Other calculated HRV metrics depending on the implementation of `calculate_hrv_indices`. These are NaN for 
+              windows with fewer than `MIN_PEAKS_PER_WINDOW` R-peaks.
+
+    """
+    # The metrics are collected as one dictionary per window, which is converted to a DataFrame once at the end
+    hrv_rows = list(iter_windowed_hrv(signals_df, parameters, export_segment_plot, figure_output_dir, segment_name))
+    if not hrv_rows:
+        return pd.DataFrame()
+    
+    # Return HRV metrics DataFrame. The window columns are (re)moved to the end, in case the first window had too few peaks.
+    hrv_indices_df = pd.DataFrame(hrv_rows)
+    return hrv_indices_df[[column for column in hrv_indices_df.columns if column not in WINDOW_COLUMNS] + WINDOW_COLUMNS]
+
+def iter_windowed_hrv(
+    signals_df: pd.DataFrame, 
+    parameters: Dict, 
+    export_segment_plot: bool = False, 
+    figure_output_dir: Optional[Union[Path, str]] = Path().cwd()/"segment_figures",
+    segment_name: str = ""
+) -> Iterator[Dict[str, float]]:
+    """
+    Generator version of `calculate_windowed_HRV_metrics` that yields the HRV metrics of one analysis window at a time, 
+    such that they can be processed (e.g., written to disk) without holding the metrics of all windows in memory.
+    Windows for which the metrics cannot be calculated are skipped.
+
+    Args:
+        signals_df (pd.DataFrame): A DataFrame containing ECG signal data, see `calculate_windowed_HRV_metrics`.
+        parameters (Dict): A dictionary containing the analysis parameters, see `calculate_windowed_HRV_metrics`.
+        export_segment_plot (bool, optional): If True, will save a plot of each ECG segment. Default is False.
+        figure_output_dir (Optional[Union[Path, str]], optional): Directory where segment plots will be saved if `export_segment_plot` is True.
+            Not used (and can be None) if `export_segment_plot` is False.
+        segment_name (str, optional): The name of the segment, used for the file names and titles of the plots.
+
+    Raises:
+        ValueError: If the required columns are missing from the input DataFrame (when the first window is requested).
 
+    Yields:
+        Dict[str, float]: The HRV metrics of the window followed by the window columns ('start_index', 'stop_index', 
+            'analysis_window', 'heart_rate_bpm'). Windows with fewer than `MIN_PEAKS_PER_WINDOW` R-peaks 
+            only contain the window columns.
     """
     # Check if expected columns are present
     expected_columns = ['ECG_Raw', 'ECG_Clean', 'ECG_R_Peaks']
@@ -252,45 +433,64 @@ def calculate_windowed_HRV_metrics(
         if col not in signals_df.columns:
             raise ValueError(f"Column '{col}' is missing from the DataFrame.")
         
-    # Setup window size
+    # Setup window size. The parameters are looked up once instead of per analysis window.
+    sampling_frequency = parameters['general'].get('sampling_frequency', 500)
+    frequency_settings = _get_hrv_frequency_settings(parameters)
+    compute_all_time_metrics = parameters['general'].get('compute_all_time_metrics', True)
     window_size = int(parameters['general']['analysis_window_seconds'] * parameters['general']['sampling_frequency'])
-    hrv_indices_df = pd.DataFrame()
+    
+    # The windows are sliced from the sample positions of the R-peaks, which is all that is needed for the HRV metrics, 
+    # instead of from the DataFrame (which creates a DataFrame with its own index per window)
+    time_index = signals_df.index.to_numpy()
+    peak_samples = np.flatnonzero(signals_df['ECG_R_Peaks'].to_numpy())
+    n_samples = len(signals_df)
+    
+    # Set up the output of the segment plots once (instead of per analysis window)
+    if export_segment_plot:
+        figure_output_dir = Path(figure_output_dir)
+        figure_output_dir.mkdir(parents=True, exist_ok=True)
+        segment_name = segment_name.replace("/", "_")
     
     # Calculate metrics per analysis window
-    for window_count, peaks_analysis_window_df in enumerate(iterate_batches(signals_df, window_size)):
-        # Define window start and end based on the df's index, which should be in relative time (i.e., starting from 0)
-        sample_start_index = peaks_analysis_window_df.index.min()
-        sample_stop_index = peaks_analysis_window_df.index.max()
+    for window_count, window_start in enumerate(range(0, n_samples, window_size)):
+        window_stop = min(window_start + window_size, n_samples)
+        
+        # Define window start and end based on the df's index (in seconds), which is sorted
+        sample_start_index = time_index[window_start]
+        sample_stop_index = time_index[window_stop - 1]
+        
+        # The R-peaks within the window, relative to the start of the window
+        peak_start, peak_stop = np.searchsorted(peak_samples, [window_start, window_stop])
+        window_peaks = peak_samples[peak_start:peak_stop] - window_start
         
         # Calculate metrics
         try:
-            heart_rate = calculate_heartrate(peaks_analysis_window_df, parameters)
-            hrv_indices_tmp_df = calculate_hrv_indices(peaks_analysis_window_df, parameters)
-            hrv_indices_tmp_df = (
-                hrv_indices_tmp_df
-                .assign(
-                    start_index=sample_start_index, 
-                    stop_index=sample_stop_index, 
-                    analysis_window=window_count,
-                    heart_rate_bpm=heart_rate
-                )
+            heart_rate = (60 / ((window_stop - window_start) / sampling_frequency)) * len(window_peaks)
+            if len(window_peaks) < MIN_PEAKS_PER_WINDOW:
+                # Too few peaks for meaningful HRV metrics (or any at all), so NeuroKit2 is not called. 
+                # The window only gets the window columns, the metrics are filled with NaN in the DataFrame.
+                hrv_row = {}
+            else:
+                hrv_row = _calculate_hrv_indices(window_peaks, sampling_frequency, frequency_settings, compute_all_time_metrics)
+            hrv_row.update(
+                start_index=sample_start_index, 
+                stop_index=sample_stop_index, 
+                analysis_window=window_count,
+                heart_rate_bpm=heart_rate
             )
-            
-            # concatenate the metrics
-            hrv_indices_df = pd.concat([hrv_indices_df, hrv_indices_tmp_df])
         except Exception as e:
             print(f"Error calculating HRV metrics for window {window_count}: {e}")
+            hrv_row = None
         
         # Visualize the segment if required
         if export_segment_plot:
-            segment_name = segment_name.replace("/", "_")
             output_file = str(figure_output_dir / f"{segment_name}_{window_count}.png")
-            Path(figure_output_dir).mkdir(parents=False, exist_ok=True)
-            plot_utils.plot_ecg_segment(peaks_analysis_window_df, 
+            plot_utils.plot_ecg_segment(signals_df.iloc[window_start:window_stop], 
                              output_file,
                              figure_title=segment_name)
-    # Return HRV metrics DataFrame
-    return hrv_indices_df
+        
+        if hrv_row is not None:
+            yield hrv_row
 
 def ecg_preprocess(raw_ecg_series: pd.Series, parameters: Dict) -> pd.DataFrame:
     """
@@ -312,9 +512,9 @@ def ecg_preprocess(raw_ecg_series: pd.Series, parameters: Dict) -> pd.DataFrame:
 
     Returns:
         pd.DataFrame: A DataFrame containing the following columns:
-            - 'ECG_Raw': The original raw ECG signal.
-            - 'ECG_Clean': The cleaned ECG signal.
-            - 'ECG_R_Peaks': Detected R-peaks in the signal (marked with 1).
+            - 'ECG_Raw': The original raw ECG signal (float32).
+            - 'ECG_Clean': The cleaned ECG signal (float32).
+            - 'ECG_R_Peaks': Detected R-peaks in the signal (marked with 1, int8).
             - 'ECG_Quality': The calculated signal quality.
 
     Example:
@@ -331,21 +531,27 @@ def ecg_preprocess(raw_ecg_series: pd.Series, parameters: Dict) -> pd.DataFrame:
         ValueError: If the input ECG series is not of type `pd.Series`.
     """
     raw_ecg_series.name = 'ECG_Raw'
-    time_index = raw_ecg_series.index # if a dedicated time index is given, it probably arrives via the raw data. Since it will be lost in the other calculations, we store it here and re-assign it later
-    raw_ecg_series = raw_ecg_series.reset_index(drop=True)
+    # float32 is ample precision for ECG samples and halves the memory (no copy if the data was loaded as float32)
+    raw_ecg_series = raw_ecg_series.astype(np.float32, copy=False)
     
-    ecg_cleaned_series = clean_ecg(raw_ecg_series, parameters)
-    peak_df, rpeaks = find_peaks(ecg_cleaned_series, parameters)
-    # signal_quality = calculate_signal_quality(ecg_cleaned_series, rpeaks['ECG_R_Peaks'], parameters)
+    ecg_cleaned = clean_ecg(raw_ecg_series, parameters)
+    peak_df, rpeaks = find_peaks(ecg_cleaned, parameters)
+    # signal_quality = calculate_signal_quality(ecg_cleaned, rpeaks['ECG_R_Peaks'], parameters)
     
-    # Create a composite dataframe containing the entire signal and peak information
-    signals_df = pd.concat([
-            ecg_cleaned_series.to_frame(),
-            raw_ecg_series.to_frame(),
-            peak_df
-        ], axis=1)
+    # Create a composite dataframe containing the entire signal and peak information in one go from the arrays, 
+    # with the time index of the raw data (if a dedicated time index is given, it probably arrives via the raw data). 
+    # NeuroKit2's filters return float64, so the cleaned signal is only downcast after the peak detection (such that 
+    # the peaks are unaffected). The R-peaks are 0/1 markers, for which int8 suffices.
+    signals_df = pd.DataFrame(
+        {
+            'ECG_Clean': ecg_cleaned.astype(np.float32),
+            'ECG_Raw': raw_ecg_series.to_numpy(),
+            'ECG_R_Peaks': peak_df['ECG_R_Peaks'].to_numpy(dtype=np.int8),
+        },
+        index=raw_ecg_series.index,
+        copy=False
+    )
     # signals_df = signals_df.assign(ECG_Quality=signal_quality)
-    signals_df.index = time_index
     
     return signals_df
 
@@ -367,3 +573,22 @@ def iterate_batches(df: pd.DataFrame, batch_size: int):
     """
     for start in range(0, len(df), batch_size):
         yield df.iloc[start:start + batch_size]
+
+def iterate_batches_ndarray(data: Union[pd.DataFrame, pd.Series, np.ndarray], batch_size: int):
+    """Iterates over the values of a DataFrame, Series, or array in batches of a specific size.
+
+    Faster alternative to `iterate_batches` for purely numeric processing: the values are converted to a 
+    numpy array once, and each batch is a view into that array (no DataFrame or index is created per batch).
+    Note that the values of a DataFrame with mixed dtypes are converted to a (copied) object array, so 
+    preferably pass a single column or only columns of the same dtype.
+
+    Args:
+        data (Union[pd.DataFrame, pd.Series, np.ndarray]): The data to iterate over.
+        batch_size (int): The number of rows per batch.
+
+    Yields:
+        np.ndarray: A view of the values of the current batch.
+    """
+    values = data.to_numpy() if isinstance(data, (pd.DataFrame, pd.Series)) else np.asarray(data)
+    for start in range(0, len(values), batch_size):
+        yield values[start:start + batch_size]
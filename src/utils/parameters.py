@@ -3,8 +3,10 @@ Default Parameters and functions related to changing parameters
 """
 
 
-from typing import Dict, List
-from copy import deepcopy
+from typing import Dict, List, Mapping, Optional, Set, Tuple, Union
+from types import MappingProxyType
+import functools
+import json
 
 # Default parameters
 # Visit Neurokit website for parameters: https://neuropsychology.github.io/NeuroKit/_modules/neurokit2/signal/signal_filter.html#signal_filter
@@ -14,7 +16,9 @@ base_params = {
     'general': {
         'sampling_frequency': 500,
         'analysis_window_seconds': 30, # calculate HRV metrics in non-overlapping windows.
-        'compute_hrv_frequency_metrics': False # might not work if analysis window is short
+        'compute_hrv_frequency_metrics': False, # might not work if analysis window is short
+        'compute_all_time_metrics': True, # if False, only the basic time-domain HRV metrics (e.g., HRV_RMSSD) are computed, which is much faster
+        'export_segment_signals': False # if True, the segmented raw and cleaned signals and the identified peaks are exported as well
     },
     'cleaning': {
         'method': 'neurokit',
@@ -62,9 +66,84 @@ base_params = {
 }
 
 
+# IDs of the subjects that have customized parameters in `configure_ecg_params` or `configure_segmentation_params`. 
+# All other subjects share the default parameters, which are then only resolved once.
+# Add the subject ID here when adding a customization below!
+SUBJECT_OVERRIDES: Set[int] = set()
+
+
 ########################################################################################
 
 
+def clone_params(pipeline_params: Mapping) -> Dict:
+    """
+    Creates an independent copy of a (nested) parameter dictionary.
+
+    The parameter dictionaries only contain dictionaries, lists and immutable values (ints, floats, strings, bools), 
+    so only the dictionaries and lists need to be copied. This is a lot cheaper than `copy.deepcopy`, which has to 
+    inspect (and memoize) every single value. Read-only parameters (as returned by `resolve_subject_params`) are 
+    turned into regular dictionaries and lists again, e.g., to modify or to export them.
+
+    Args:
+        pipeline_params (Mapping): The parameter dictionary to copy (e.g., `base_params`).
+
+    Returns:
+        Dict: A copy of the parameter dictionary that can be modified without affecting the original.
+    """
+    return {
+        key: clone_params(value) if isinstance(value, Mapping) else (list(value) if isinstance(value, (list, tuple)) else value)
+        for key, value in pipeline_params.items()
+    }
+
+def freeze_params(pipeline_params: Mapping) -> Mapping:
+    """
+    Creates a read-only view of a (nested) parameter dictionary: dictionaries become `MappingProxyType`s and 
+    lists become tuples. Use `clone_params` to get a modifiable copy again.
+
+    Args:
+        pipeline_params (Mapping): The parameter dictionary to freeze.
+
+    Returns:
+        Mapping: The read-only parameters.
+    """
+    return MappingProxyType({
+        key: freeze_params(value) if isinstance(value, Mapping) else (tuple(value) if isinstance(value, list) else value)
+        for key, value in pipeline_params.items()
+    })
+
+def resolve_subject_params(subject_id: Optional[int], pipeline_params: Mapping) -> Tuple[Mapping, Mapping, Mapping]:
+    """
+    Resolves the segmentation parameters and the child and mother ECG parameters of a subject (dyad) by calling
+    `configure_segmentation_params` and `configure_ecg_params`.
+
+    Subjects that are not listed in `SUBJECT_OVERRIDES` get the default parameters (resolved with `subject_id=None`). 
+    The result is cached per subject ID and per content of `pipeline_params`, so the default parameters are only 
+    configured once, and a subject with overrides that is processed more than once (e.g., multiple waves) is also 
+    only configured once. Because the cached parameters are shared, they are returned read-only 
+    (see `freeze_params`). Use `clone_params` to get modifiable dictionaries.
+
+    Args:
+        subject_id (Optional[int]): The ID of the subject being processed.
+        pipeline_params (Mapping): The base dictionary containing the default pipeline parameters 
+            (typically the `base_params` dictionary). Must only contain plain python types (JSON serializable).
+
+    Returns:
+        Tuple[Mapping, Mapping, Mapping]: The read-only segmentation, child and mother parameters.
+    """
+    if subject_id not in SUBJECT_OVERRIDES:
+        subject_id = None
+    # The JSON string is a hashable snapshot of the parameters, so changes to pipeline_params are never 
+    # served from a stale cache entry
+    return _resolve_subject_params_cached(subject_id, json.dumps(pipeline_params))
+
+@functools.lru_cache(maxsize=256)
+def _resolve_subject_params_cached(subject_id: Optional[int], pipeline_params_json: str) -> Tuple[Mapping, Mapping, Mapping]:
+    pipeline_params = json.loads(pipeline_params_json)
+    segmentation_params = configure_segmentation_params(subject_id, pipeline_params)
+    child_params, mother_params = configure_ecg_params(subject_id, segmentation_params)
+    return freeze_params(segmentation_params), freeze_params(child_params), freeze_params(mother_params)
+
+
 # Only configure here the parameters to be updated for a given subject if they
 # differ from the default parameters specfied above.
 def configure_ecg_params(subject_id: int, pipeline_params: Dict) -> List[Dict]:
@@ -101,10 +180,10 @@ def configure_ecg_params(subject_id: int, pipeline_params: Dict) -> List[Dict]:
         List[Dict]: A list of two dictionaries, `child_params` and `mother_params`, where both contain 
                     the customized pipeline parameters based on the subject ID.
     """
-    child_params = deepcopy(pipeline_params)
-    mother_params = deepcopy(pipeline_params)
+    child_params = clone_params(pipeline_params)
+    mother_params = clone_params(pipeline_params)
     
-    # Customize parameters based on subject_id
+    # Customize parameters based on subject_id (and add the subject_id to SUBJECT_OVERRIDES)
     # if subject_id == 8:
     #     child_params['cleaning'].update({"powerline": 40})
 
@@ -149,9 +228,9 @@ def configure_segmentation_params(subject_id: int, pipeline_params: Dict) -> Dic
         Dict: The customized segmentation parameters based on the subject ID. 
               If no customizations are made, the default segmentation settings are returned.
     """
-    parameters = deepcopy(pipeline_params)
+    parameters = clone_params(pipeline_params)
     
-    # Customize parameters based on subject_id
+    # Customize parameters based on subject_id (and add the subject_id to SUBJECT_OVERRIDES)
     # if subject_id == 8:
     #     parameters['segmentation']['baseline'].update({"duration": 250})
     
@@ -12,7 +12,7 @@ https://neuropsychology.github.io/NeuroKit/functions/ecg.html
 # fmt: off
 from typing import Dict, Tuple, Union, List, Optional, Any
 import pandas as pd
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 from pathlib import Path
 # fmt: on
 
@@ -22,9 +22,10 @@ from pathlib import Path
 #### PLOTTING FUNCTIONS ####
 ############################
 
-def plot_ecg_segment(df: pd.DataFrame, output_file: Union[Path, str], figure_title:str="") -> plt.Figure:
+def plot_ecg_segment(df: pd.DataFrame, output_file: Union[Path, str], figure_title:str="") -> Figure:
     """
     Plots an ECG segment showing the raw and the preprocessed ECG signal with marked R-peaks, and saves the plot as a PNG file.
+    The figure is created without pyplot, such that segments can be plotted from multiple threads at the same time.
 
     Args:
         df (pd.DataFrame): A DataFrame containing the ECG data. It must include the following columns:
@@ -37,7 +38,7 @@ def plot_ecg_segment(df: pd.DataFrame, output_file: Union[Path, str], figure_tit
         ValueError: If the required columns are missing from the input DataFrame.
 
     Returns:
-        plt.Figure: The matplotlib figure object for the created plot.
+        Figure: The matplotlib figure object for the created plot.
     """
     expected_columns = ['ECG_Raw', 'ECG_Clean', 'ECG_R_Peaks']
     for col in expected_columns:
@@ -46,9 +47,10 @@ def plot_ecg_segment(df: pd.DataFrame, output_file: Union[Path, str], figure_tit
         
     sample_start_index = df.index.min()
     sample_stop_index = df.index.max()
-    fig, axes = plt.subplots(2, 1, figsize=(13, 6), constrained_layout=True)
+    fig = Figure(figsize=(13, 6), constrained_layout=True)
+    axes = fig.subplots(2, 1)
     
-    plt.suptitle(f'{figure_title}: ECG Segment from {sample_start_index} to {sample_stop_index} seconds', fontsize=16, x = 0.2)
+    fig.suptitle(f'{figure_title}: ECG Segment from {sample_start_index} to {sample_stop_index} seconds', fontsize=16, x = 0.2)
     
     axes[0].set_title(f'Raw ECG')
     axes[0].plot(df['ECG_Raw'], color = 'k')
@@ -63,8 +65,7 @@ def plot_ecg_segment(df: pd.DataFrame, output_file: Union[Path, str], figure_tit
         if row_series['ECG_R_Peaks'] == 1:
             axes[1].scatter(row_series.name, row_series['ECG_Clean'], color='red', marker='v', zorder=3)
    
-    # Save the plot
-    plt.savefig(output_file, dpi=135, bbox_inches='tight')
-    plt.close()
+    # Save the plot (the figure is not managed by pyplot, so it does not have to be closed)
+    fig.savefig(output_file, dpi=135, bbox_inches='tight')
 
     return fig